@@ -0,0 +1,232 @@
+# This class contains a backtester that generalizes maximize_profit
+# to any number of betting strategies. A strategy is any function
+# that takes the weighted profits of find_probabilities for the
+# previous spin (an array whose last axis is the bet size) and returns
+# the bet size (1, 2 or 3) to place on the next spin. Every strategy
+# is evaluated over the same arrays in one pass:
+#   -backtest replays a recorded spin sequence, loaded once as an
+#    Nx9 array from the spins table (or from any other source)
+#   -simulate_sessions plays Monte Carlo sessions of any length by
+#    walking the reel states with offsets and offsetweights, split
+#    across a process pool
+# Each strategy is reported with the player's cost, payout, net profit,
+# worst drawdown and whether (and when) the bankroll ran out.
+
+import argparse
+import database
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import runanalyses as ra
+
+# paytable that maximize_profit plays against
+dynamicwinnings = {'1': 2, '2': 8, '3': 20, '4': 0, '5': 64, '6': 0, '7': 0}
+
+# upper bound on the entries of one (sessions x spins x 3) block of a
+# Monte Carlo chunk
+block_limit = 2 ** 22
+
+# input: bet size, weighted profits
+# output: the same bet size for every spin
+def static_bet(bet, weights):
+    return np.full(np.shape(weights)[:-1], bet, dtype=np.int64)
+
+# input: weighted profits
+# output: bet sizes chosen the way maximize_profit chooses them
+#
+# Bets 3 if the weight increases from 2 to 3 diamonds, else 2 if it
+# increases from 1 to 2, else 1.
+def heuristic_bet(weights):
+    weights = np.asarray(weights)
+    return np.where(weights[..., 1] != weights[..., 2], 3, np.where(weights[..., 0] != weights[..., 1], 2, 1))
+
+# input: price of one diamond in expected winnings, weighted profits
+# output: bet sizes maximizing weight - margin * betsize, ties going
+#         to the smaller bet
+#
+# With margin 0 this is the heuristic; with margin 1 only bets whose
+# expected winnings cover their cost are raised.
+def threshold_bet(margin, weights):
+    weights = np.asarray(weights)
+    return np.argmax(weights - margin * np.arange(1, 4), axis=-1) + 1
+
+# the strategies compared by default
+strategies = {
+    'static 1': partial(static_bet, 1),
+    'static 2': partial(static_bet, 2),
+    'static 3': partial(static_bet, 3),
+    'heuristic': heuristic_bet,
+    'threshold 0.5': partial(threshold_bet, 0.5),
+    'threshold 1': partial(threshold_bet, 1),
+    'threshold 2': partial(threshold_bet, 2)
+}
+
+# input: mysql cursor
+# output: Nx9 array of every spin in the spins table, in order
+def load_spins(dbcursor):
+    database.use_database(dbcursor)
+    dbcursor.execute('SELECT b1, b2, b3, b4, b5, b6, b7, b8, b9 FROM spins ORDER BY s')
+    return np.array(dbcursor.fetchall(), dtype=np.int64).reshape(-1, 9)
+
+# input: Nx9 array of spins, dictionary of payout winning values
+# output: Nx3 array of find_probabilities for every spin
+#
+# Spins whose three windows each appear once on their reel resolve
+# through one array lookup; the rest (ambiguous or unrecognised
+# windows) fall back to find_probabilities.
+def spin_weights(spins, winnings=dynamicwinnings):
+    index = ra.window_index()
+    lookup = np.full((3, 512), -1, dtype=np.int64)
+    for reel in range(3):
+        for window, positions in index[reel].items():
+            if len(positions) == 1 and all(0 <= symbol < 8 for symbol in window):
+                lookup[reel][64 * window[0] + 8 * window[1] + window[2]] = positions[0]
+
+    spins = np.asarray(spins)
+    valid = ((spins >= 0) & (spins < 8)).all(axis=1)
+    codes = np.where(valid[:, np.newaxis], spins, 0)
+    indices = np.stack([lookup[reel][64 * codes[:, reel] + 8 * codes[:, 3 + reel] + codes[:, 6 + reel]]
+                        for reel in range(3)], axis=1)
+    located = valid & (indices >= 0).all(axis=1)
+
+    table = ra.outcome_table(winnings)['weighted']
+    weights = np.zeros((len(spins), 3))
+    weights[located] = table[indices[located, 0], indices[located, 1], indices[located, 2]]
+    for row in np.flatnonzero(~located):
+        weights[row] = ra.find_probabilities([int(block) for block in spins[row]], winnings)
+    return weights
+
+# input: MxN array of bets, MxN array of payouts of those bets,
+#        starting bankroll (None to ignore ruin), score of the spins
+#        before these ones (optional), number of those spins
+# output: dictionary of per-session arrays: cost, payout, net profit,
+#         highest net profit, worst drawdown and the spin the bankroll
+#         ran out (-1 if never)
+#
+# Net profit is from the player's side. The bankroll runs out at the
+# first spin the player cannot afford the next bet. Given the score of
+# the earlier spins of the same sessions, the spins carry on from it,
+# so long sessions can be scored one block at a time.
+def score(bets, payouts, bankroll=None, previous=None, first=0):
+    shape = np.shape(bets)[:-1]
+    if previous is None:
+        previous = {'cost': np.zeros(shape, dtype=np.int64), 'payout': np.zeros(shape, dtype=np.int64),
+                    'net': np.zeros(shape, dtype=np.int64), 'peak': np.zeros(shape, dtype=np.int64),
+                    'drawdown': np.zeros(shape, dtype=np.int64), 'ruin': np.full(shape, -1, dtype=np.int64)}
+    net = previous['net'][..., np.newaxis] + np.cumsum(payouts - bets, axis=-1)
+    peaks = np.maximum(np.maximum.accumulate(np.maximum(net, 0), axis=-1), previous['peak'][..., np.newaxis])
+    drawdown = np.maximum((peaks - net).max(axis=-1), previous['drawdown'])
+    ruin = previous['ruin']
+    if bankroll is not None:
+        # bankroll left before each spin, compared to the bet placed on it
+        before = bankroll + np.concatenate([previous['net'][..., np.newaxis], net[..., :-1]], axis=-1)
+        broke = before < bets
+        ruin = np.where((ruin < 0) & broke.any(axis=-1), first + broke.argmax(axis=-1), ruin)
+    return {'cost': previous['cost'] + bets.sum(axis=-1), 'payout': previous['payout'] + payouts.sum(axis=-1),
+            'net': net[..., -1], 'peak': peaks[..., -1], 'drawdown': drawdown, 'ruin': ruin}
+
+# input: Nx9 array of spins, first spin of the machine (decides the
+#        first bet), dictionary of strategies, dictionary of payout
+#        winning values, starting bankroll
+# output: dictionary of results per strategy
+#
+# Replays the spins in order. Like maximize_profit, this assumes the
+# spins are adjacent to one another.
+def backtest(spins, initialspin, policies=strategies, winnings=dynamicwinnings, bankroll=None):
+    spins = np.asarray(spins)
+    previous = np.vstack([np.asarray(initialspin)[np.newaxis, :], spins[:-1]])
+    weights = spin_weights(previous, winnings)
+    payouts = ra.spin_payouts(spins, winnings)
+
+    names = list(policies)
+    bets = np.stack([np.asarray(policies[name](weights)) for name in names])
+    paid = np.take_along_axis(payouts[np.newaxis, :, :], (bets - 1)[:, :, np.newaxis], axis=2)[:, :, 0]
+    scores = score(bets, paid, bankroll)
+    return {name: {key: int(scores[key][n]) for key in scores} for n, name in enumerate(names)}
+
+# input: number of sessions, spins per session, seed sequence, dictionary
+#        of strategies, dictionary of payout winning values, bankroll
+# output: dictionary of per-session score arrays per strategy
+#
+# Plays one chunk of sessions. Each session starts at a random state
+# and every spin applies an offset drawn with offsetweights, so the
+# spins are truly consecutive; the outcome of each state comes from
+# outcome_table. The spins are played in blocks of at most block_limit
+# entries, each carrying on from the last state and score of the one
+# before, so a session can be any length.
+def simulate_chunk(numsessions, numspins, seedseq, policies, winnings, bankroll):
+    rng = np.random.default_rng(seedseq)
+    table = ra.outcome_table(winnings)
+    steps = np.array(ra.offsets, dtype=np.int64)
+    blocksize = max(1, block_limit // (3 * numsessions))
+
+    current = rng.integers(0, 20, size=(numsessions, 1, 3))
+    results = {name: None for name in policies}
+    for first in range(0, numspins, blocksize):
+        choice = rng.choice(len(steps), size=(numsessions, min(blocksize, numspins - first)), p=ra.offsetweights)
+        states = np.concatenate([current, current + np.cumsum(steps[choice], axis=1)], axis=1) % 20
+        weights = table['weighted'][states[:, :-1, 0], states[:, :-1, 1], states[:, :-1, 2]]
+        payouts = table['payouts'][states[:, 1:, 0], states[:, 1:, 1], states[:, 1:, 2]].astype(np.int64)
+        current = states[:, -1:]
+
+        for name in policies:
+            bets = np.asarray(policies[name](weights))
+            paid = np.take_along_axis(payouts, (bets - 1)[:, :, np.newaxis], axis=2)[:, :, 0]
+            results[name] = score(bets, paid, bankroll, results[name], first)
+    return results
+
+# input: number of sessions, spins per session, seed, worker processes,
+#        dictionary of strategies, dictionary of payout winning values,
+#        starting bankroll, sessions per chunk
+# output: dictionary of per-session score arrays per strategy
+#
+# Splits the sessions into chunks seeded from one seed and plays them,
+# in parallel when more than one worker is given. Strategies must be
+# picklable (module-level functions or partials) to use workers.
+def simulate_sessions(numsessions, numspins, seed=None, workers=1, policies=strategies,
+                      winnings=dynamicwinnings, bankroll=None, chunksize=None):
+    if chunksize is None:
+        chunksize = max(1, min(numsessions, block_limit // max(1, numspins * 3)))
+    sizes = [min(chunksize, numsessions - start) for start in range(0, numsessions, chunksize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(size, numspins, seedseq, policies, winnings, bankroll) for size, seedseq in zip(sizes, seeds)]
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunks = list(pool.map(simulate_chunk, *zip(*args)))
+    else:
+        chunks = [simulate_chunk(*arg) for arg in args]
+    return {name: {key: np.concatenate([chunk[name][key] for chunk in chunks]) for key in chunks[0][name]}
+            for name in policies}
+
+# input: result of simulate_sessions
+# output: N/A
+#
+# Prints the mean and spread of each strategy's sessions.
+def print_summary(results):
+    for name in results:
+        result = results[name]
+        line = (name.upper() + ': NET ' + str(round(result['net'].mean(), 2)) +
+                ' (P5/P95 ' + str(np.percentile(result['net'], [5, 95]).round(1).tolist()) + ')' +
+                ', COST ' + str(round(result['cost'].mean(), 1)) +
+                ', DRAWDOWN ' + str(round(result['drawdown'].mean(), 1)))
+        print(line + ', RUIN ' + str(round(float((result['ruin'] >= 0).mean()), 4)))
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sqlite', metavar='PATH', help='read spins from a local SQLite file instead of MySQL')
+    parser.add_argument('--sessions', type=int, default=0, help='Monte Carlo sessions to play instead of the recorded spins')
+    parser.add_argument('--spins', type=int, default=1000, help='spins per Monte Carlo session')
+    parser.add_argument('--bankroll', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.sessions:
+        print_summary(simulate_sessions(args.sessions, args.spins, args.seed, args.workers, bankroll=args.bankroll))
+    else:
+        # the first recorded spin only decides the first bet
+        spins = load_spins(database.get_connection(path=args.sqlite).cursor())
+        results = backtest(spins[1:], spins[0], bankroll=args.bankroll)
+        for name in results:
+            print(name.upper() + ': ' + str(results[name]))
@@ -0,0 +1,236 @@
+# This class contains the benchmarks of the hot paths of the project.
+# They run against the bundled dataset/ and raw_images/ folders with an
+# in-memory SQLite database standing in for the MySQL server, so no
+# setup is needed beyond checking out the repository:
+#
+#   python bench.py --output bench.json
+#   python bench.py --compare bench.json --threshold 0.2
+#
+# The fixture database holds the raw images labelled by stream_spins,
+# which is itself the first benchmark. Every benchmark is then run a
+# number of times and its fastest, median and mean times are written
+# as JSON along with the commit and versions they were measured on.
+# Bodies that take less than min_run_time are called repeatedly within
+# each run and timed per call, so short benchmarks are not lost in
+# timer and scheduler noise. Comparing against an earlier JSON file
+# flags every benchmark whose fastest time grew by more than the
+# threshold, and exits with status 1 if any did.
+#
+# Caches that would otherwise survive between runs (payout counts,
+# block histograms, crop boxes) are pointed at a temporary folder, and
+# the benchmarks that depend on them are measured both cold and warm.
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import numpy as np
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import calibrate
+import database
+import geometry
+import importdata
+import runanalyses as ra
+import spinstore
+
+# workspace the benchmarks run in: this checkout
+workspace = os.path.dirname(os.path.abspath(__file__))
+
+# slowdown of the fastest run, as a fraction, above which a benchmark
+# is flagged
+threshold = 0.2
+
+# shortest run, in seconds; faster bodies are repeated within each run
+min_run_time = 0.2
+
+# most calls of the body within one run
+max_loops = 10000
+
+# seed of the random spins of test_combinations, so every run plays
+# the same spins and stops at the same one
+seed = 0
+
+# input: function to time, number of runs, function run before every
+#        call and not timed (optional), number of items each call handles
+# output: dictionary of the fastest, median and mean time of a call in
+#         seconds, the number of runs, of calls per run and of items
+#         per call
+#
+# The first call decides how many calls make up a run: enough to last
+# min_run_time, like timeit's autorange. Each run reports the mean time
+# of its calls. Anything the function prints is discarded.
+def measure(function, runs=5, setup=None, items=1):
+    def call():
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            return time.perf_counter() - start
+
+    times = []
+    loops = None
+    for run in range(runs):
+        total = call()
+        if loops is None:
+            loops = max(1, min(max_loops, math.ceil(min_run_time / max(total, 1e-9))))
+        for loop in range(loops - 1):
+            total = total + call()
+        times.append(total / loops)
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+            'runs': runs, 'loops': loops, 'items': items}
+
+# input: number of raw images in the fixture
+# output: (database cursor of an in-memory SQLite database holding the
+#         labelled spins, Nx9 array of the spins, benchmark of labelling them)
+def fixture(numspins):
+    rows = []
+
+    def label():
+        rows[:] = importdata.stream_spins(range(1, numspins + 1))
+
+    labelling = measure(label, 1, items=numspins)
+    db = database.get_connection(path=':memory:')
+    dbcursor = db.cursor()
+    database.create_tables(dbcursor)
+    importdata.import_spins(dbcursor, rows)
+    return dbcursor, np.array([row[1:] for row in rows], dtype=np.int64), labelling
+
+# input: number of raw images in the fixture, runs of each benchmark,
+#        temporary folder for caches and outputs
+# output: dictionary of benchmark results by name
+def run_benchmarks(numspins, runs, tempdir):
+    importdata.root_dir = workspace
+    ra.cache_path = os.path.join(tempdir, 'payout_counts.json')
+    calibrate.cache_path = os.path.join(tempdir, 'block_histograms.npz')
+    geometry.cache_path = os.path.join(tempdir, 'geometry_cache.json')
+    results = {}
+
+    dbcursor, spins, results['stream_spins'] = fixture(numspins)
+    blocks = [os.path.join(workspace, 'dataset', 's' + str(spin), 'b' + str(block) + '.png')
+              for spin in range(1, 11) for block in range(1, 10)]
+    splits = os.path.join(tempdir, 'split')
+    os.makedirs(splits, exist_ok=True)
+
+    def cold_histograms():
+        if os.path.exists(calibrate.cache_path):
+            os.remove(calibrate.cache_path)
+
+    def cold_payouts():
+        ra.payoutcache.clear()
+        ra.tableversions.clear()
+        if os.path.exists(ra.cache_path):
+            os.remove(ra.cache_path)
+
+    def empty_table():
+        dbcursor.execute('DELETE FROM spins')
+        dbcursor.execute('COMMIT')
+
+    rows = [(n + 1,) + tuple(spin) for n, spin in enumerate(spins.tolist())]
+    winnings = {'1': 2, '2': 8, '3': 20, '4': 0, '5': 64, '6': 0, '7': 0}
+    storepath = os.path.join(tempdir, 'bench.spins')
+    spinstore.create(storepath)
+    spinstore.append(storepath, spins)
+    store = spinstore.open_spins(storepath)
+
+    results['split_image'] = measure(lambda: [importdata.split_image(n, splits) for n in range(1, 6)], runs, items=5)
+    results['label_image'] = measure(lambda: [importdata.label_image(path) for path in blocks], runs, items=len(blocks))
+    results['label_spin'] = measure(lambda: [importdata.label_spin(n, workspace) for n in range(1, 11)], runs, items=10)
+    results['test_correctness_cold'] = measure(importdata.test_correctness, runs, cold_histograms, 900)
+    results['test_correctness'] = measure(importdata.test_correctness, runs, items=900)
+    results['import_spins'] = measure(lambda: importdata.import_spins(dbcursor, rows), runs, empty_table, len(rows))
+    ra.r.seed(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        played = ra.test_combinations(100000)
+    results['test_combinations'] = measure(lambda: ra.test_combinations(100000), runs, lambda: ra.r.seed(seed), played)
+    results['find_frequencies'] = measure(lambda: [ra.find_frequencies(dbcursor, bet) for bet in range(1, 4)], runs, items=3)
+    results['find_frequencies_store'] = measure(lambda: [ra.find_frequencies(None, bet, store) for bet in range(1, 4)], runs, items=3)
+    results['run_simulator_cold'] = measure(lambda: ra.run_simulator(dbcursor, winnings), runs, cold_payouts)
+    results['run_simulator'] = measure(lambda: ra.run_simulator(dbcursor, winnings), runs)
+    results['optimize_profit'] = measure(lambda: ra.optimize_profit(dbcursor), runs)
+    results['find_probabilities_cold'] = measure(lambda: ra.find_probabilities(rows[0][1:]), runs, ra.outcometables.clear)
+    results['find_probabilities'] = measure(lambda: [ra.find_probabilities(row[1:]) for row in rows], runs, items=len(rows))
+    results['maximize_profit'] = measure(lambda: ra.maximize_profit(dbcursor, rows[0][1:]), runs, items=len(rows))
+    results['maximize_profit_store'] = measure(lambda: ra.maximize_profit(None, store[0].tolist(), store), runs, items=len(rows))
+    return results
+
+# input: N/A
+# output: dictionary describing the code and machine the benchmarks ran on
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=workspace, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+# input: results of this run, results of an earlier run, threshold
+# output: list of (name, baseline time, time, change) for every
+#         benchmark whose fastest time grew by more than the threshold
+#
+# The fastest time is compared since noise only ever adds to a time.
+def regressions(results, baseline, limit=threshold):
+    flagged = []
+    for name in results:
+        if name in baseline and baseline[name]['min'] > 0:
+            change = results[name]['min'] / baseline[name]['min'] - 1
+            if change > limit:
+                flagged.append((name, baseline[name]['min'], results[name]['min'], change))
+    return flagged
+
+# input: results, results of an earlier run (optional)
+# output: N/A
+def print_results(results, baseline=None):
+    for name in results:
+        result = results[name]
+        line = (name.ljust(24) + ' MEDIAN ' + str(round(1000 * result['median'], 3)).rjust(10) + 'MS' +
+                '  MIN ' + str(round(1000 * result['min'], 3)).rjust(10) + 'MS')
+        if result['items'] > 1:
+            line = line + '  ' + str(round(result['items'] / result['median'], 1)) + '/S'
+        if baseline and name in baseline:
+            line = line + '  (' + format(result['min'] / baseline[name]['min'] - 1, '+.1%') + ')'
+        print(line)
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spins', type=int, default=1000, help='raw images labelled into the fixture database')
+    parser.add_argument('--runs', type=int, default=5, help='runs of each benchmark')
+    parser.add_argument('--output', metavar='PATH', help='write the results as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=threshold, help='slowdown of the fastest run flagged as a regression')
+    args = parser.parse_args()
+
+    # split_image reads relative to the workspace
+    os.chdir(workspace)
+    with tempfile.TemporaryDirectory() as tempdir:
+        results = run_benchmarks(args.spins, args.runs, tempdir)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            earlier = json.load(f)
+        baseline = earlier['results']
+        if earlier['environment'].get('spins') != args.spins:
+            print('WARNING: ' + args.compare + ' was measured on a fixture of ' +
+                  str(earlier['environment'].get('spins')) + ' spins, not ' + str(args.spins))
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'environment': dict(environment(), spins=args.spins, runs=args.runs), 'results': results}, f, indent=1)
+
+    if baseline is not None:
+        flagged = regressions(results, baseline, args.threshold)
+        for name, before, after, change in flagged:
+            print('REGRESSION: ' + name + ' ' + str(round(1000 * before, 3)) + 'MS -> ' +
+                  str(round(1000 * after, 3)) + 'MS (' + format(change, '+.1%') + ')')
+        if flagged:
+            sys.exit(1)
@@ -0,0 +1,241 @@
+# This class contains the tools for choosing the ranges table of
+# importdata.py. Every hand-labelled block in the dataset is reduced
+# once to a colour histogram: the blocks are rendered from a handful
+# of flat textures, so the 900 labelled blocks share only a few dozen
+# distinct RGB colours between them. The histograms are stored as the
+# array of distinct colours and a (blocks x colours) array of pixel
+# counts, cached on disk and rebuilt only when a block or labels.csv
+# changes.
+#
+# The pixel votes classify_blocks would give a block for any ranges
+# are then the counts times the label membership of each colour, so a
+# candidate ranges table is scored against all labelled blocks in about
+# a millisecond instead of decoding 900 PNGs. calibrate searches
+# the bounds automatically for the ranges that label the most blocks
+# correctly, with the widest margin between the votes of the right
+# label and those of the runner-up.
+
+import argparse
+import csv
+import cv2 as cv
+import hashlib
+import numpy as np
+import os
+import time
+import importdata
+import instrument
+
+# block labels as written in labels.csv, in label order
+symbols = ['A', 'I', 'R', 'G', 'E', 'D', 'N', 'C']
+
+# histograms of the labelled blocks, relative to the workspace
+cache_path = 'block_histograms.npz'
+
+# input: workspace path, number of labelled spins
+# output: list of (spin, block, label, block image path) for every labelled block
+def labelled_blocks(workspace, numspins=100):
+    blocks = []
+    for spin in range(1, numspins + 1):
+        filepath = os.path.join(workspace, 'dataset', 's' + str(spin))
+        with open(os.path.join(filepath, 'labels.csv'), 'r', encoding='utf-8') as csvFile:
+            reader = csv.reader(csvFile, skipinitialspace=True)
+            next(reader)
+            for row in reader:
+                blocks.append((spin, int(row[0]), symbols.index(row[1].strip()),
+                               os.path.join(filepath, 'b' + row[0].strip() + '.png')))
+    return blocks
+
+# input: list from labelled_blocks
+# output: hex digest identifying the current version of every source file
+#
+# Made from the size and modification time of each block image and
+# labels.csv, so checking the cache costs one stat per file.
+def source_key(blocks):
+    digest = hashlib.sha1()
+    paths = [block[3] for block in blocks]
+    paths = paths + sorted(set(os.path.join(os.path.dirname(path), 'labels.csv') for path in paths))
+    for path in paths:
+        stat = os.stat(path)
+        digest.update((path + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns) + '\n').encode('utf-8'))
+    return digest.hexdigest()
+
+# input: workspace path, number of labelled spins, whether to use the cache
+# output: dictionary of the distinct colours (Kx3 uint8), pixel counts per
+#         block (NxK), true labels (N) and (spin, block) of every block
+#
+# Loads the histograms from the cache if it is up to date, else decodes
+# every labelled block once and rewrites the cache.
+@instrument.stage('block_histograms')
+def block_histograms(workspace=None, numspins=100, cached=True):
+    workspace = importdata.root_dir if workspace is None else workspace
+    blocks = labelled_blocks(workspace, numspins)
+    key = source_key(blocks)
+    cachefile = os.path.join(workspace, cache_path)
+    if cached:
+        if os.path.exists(cachefile):
+            with np.load(cachefile) as stored:
+                if str(stored['key']) == key:
+                    return {name: stored[name] for name in ('colors', 'counts', 'labels', 'blocks')}
+
+    # each pixel packed as 0xRRGGBB, one row of codes per block
+    codes = []
+    for block in blocks:
+        pixels = cv.imread(block[3], cv.IMREAD_COLOR).reshape(-1, 3).astype(np.int64)
+        if instrument.enabled:
+            instrument.add(rows=1, nbytes=os.path.getsize(block[3]))
+        codes.append((pixels[:, 2] << 16) | (pixels[:, 1] << 8) | pixels[:, 0])
+    colors, inverse = np.unique(np.concatenate(codes), return_inverse=True)
+    rows = np.repeat(np.arange(len(blocks)), [len(code) for code in codes])
+    counts = np.zeros((len(blocks), len(colors)), dtype=np.int64)
+    np.add.at(counts, (rows, inverse.ravel()), 1)
+
+    histograms = {
+        'colors': np.stack([colors >> 16, (colors >> 8) & 255, colors & 255], axis=1).astype(np.uint8),
+        'counts': counts,
+        'labels': np.array([block[2] for block in blocks], dtype=np.int64),
+        'blocks': np.array([block[:2] for block in blocks], dtype=np.int64).reshape(-1, 2)
+    }
+    if cached:
+        np.savez(cachefile, key=key, **histograms)
+    return histograms
+
+# input: histograms, ranges array
+# output: Nx8 array of the pixel votes classify_blocks gives each block
+def block_votes(histograms, bounds):
+    lut = importdata.build_lookup_table(bounds)
+    colors = histograms['colors']
+    masks = lut[0][colors[:, 0]] & lut[1][colors[:, 1]] & lut[2][colors[:, 2]]
+    return histograms['counts'] @ importdata.bitcounts[masks]
+
+# input: histograms, Nx8 votes
+# output: array of labels (-1 for no votes) and array of margins
+#
+# The margin of a block is the share of its pixels by which the
+# votes of its true label beat the best other label; it is negative
+# when the block is labelled wrong.
+def label_margins(histograms, votes):
+    labels = np.argmax(votes, axis=1)
+    labels[votes.max(axis=1) == 0] = -1
+    rows = np.arange(len(votes))
+    true = votes[rows, histograms['labels']]
+    others = votes.copy()
+    others[rows, histograms['labels']] = -1
+    margins = (true - others.max(axis=1)) / histograms['counts'].sum(axis=1)
+    return labels, margins
+
+# input: histograms, ranges array
+# output: dictionary of accuracy, mean and minimum margin, 8x9 confusion
+#         matrix (true label by predicted label, the last column counting
+#         blocks with no votes) and list of (spin, block, true, predicted)
+#         for every block labelled wrong
+@instrument.stage('evaluate')
+def evaluate(histograms, bounds):
+    labels, margins = label_margins(histograms, block_votes(histograms, bounds))
+    true = histograms['labels']
+    confusion = np.zeros((8, 9), dtype=np.int64)
+    np.add.at(confusion, (true, labels), 1)
+    wrong = np.flatnonzero(labels != true)
+    return {
+        'accuracy': float((labels == true).mean()),
+        'margin': float(margins.mean()),
+        'min_margin': float(margins.min()),
+        'confusion': confusion,
+        'failed': [(int(histograms['blocks'][n][0]), int(histograms['blocks'][n][1]), int(true[n]), int(labels[n]))
+                   for n in wrong]
+    }
+
+# input: histograms, starting ranges array, maximum number of sweeps
+# output: calibrated ranges array
+#
+# Coordinate ascent over the 48 bounds. Only the distinct channel
+# values of the histogram colours can change which colours fall in a
+# box, so every bound is tried at each of them and moved to whichever
+# gives the most correct blocks, then the widest mean margin. Once no
+# bound moves, each one is centred in the gap between the colours it
+# includes and the nearest ones it excludes, so slightly different
+# shades of the same texture still land inside.
+@instrument.stage('calibrate')
+def calibrate(histograms, bounds=importdata.ranges, sweeps=10):
+    bounds = np.array(bounds, dtype=np.int64)
+    colors = histograms['colors'].astype(np.int64)
+    values = [np.unique(np.concatenate([[0, 255], colors[:, channel]])) for channel in range(3)]
+
+    def objective(candidate):
+        labels, margins = label_margins(histograms, block_votes(histograms, candidate))
+        return (int((labels == histograms['labels']).sum()), float(margins.mean()))
+
+    best = objective(bounds)
+    for sweep in range(sweeps):
+        moved = False
+        for label in range(8):
+            for side in range(2):
+                for channel in range(3):
+                    current = bounds[label][side][channel]
+                    for value in values[channel]:
+                        if (side == 0 and value > bounds[label][1][channel]) or (side == 1 and value < bounds[label][0][channel]):
+                            continue
+                        bounds[label][side][channel] = value
+                        score = objective(bounds)
+                        if score > best:
+                            best = score
+                            current = value
+                            moved = True
+                    bounds[label][side][channel] = current
+        if not moved:
+            break
+
+    # centre each bound between the included and excluded channel values
+    for label in range(8):
+        for channel in range(3):
+            channelvalues = colors[:, channel]
+            low, high = bounds[label][0][channel], bounds[label][1][channel]
+            below = channelvalues[channelvalues < low]
+            above = channelvalues[channelvalues > high]
+            inside = channelvalues[(channelvalues >= low) & (channelvalues <= high)]
+            if len(inside):
+                bounds[label][0][channel] = (below.max() + inside.min() + 1) // 2 if len(below) else 0
+                bounds[label][1][channel] = (inside.max() + above.min()) // 2 if len(above) else 255
+    return bounds
+
+# input: result of evaluate
+# output: N/A
+#
+# Prints the accuracy, the confusion matrix and every failed block.
+def print_report(report):
+    print('ACCURACY: ' + str(round(report['accuracy'], 4)) + ', MEAN MARGIN: ' + str(round(report['margin'], 4)) +
+          ', MIN MARGIN: ' + str(round(report['min_margin'], 4)))
+    print('TRUE\\LABEL ' + ' '.join(symbol.rjust(4) for symbol in symbols + ['-']))
+    for label in range(8):
+        print(symbols[label].ljust(10) + ' ' + ' '.join(str(count).rjust(4) for count in report['confusion'][label]))
+    for spin, block, true, label in report['failed']:
+        print('FAILED (spin ' + str(spin) + ', block ' + str(block) + '): ' + symbols[true] + ' labelled ' +
+              (symbols[label] if label >= 0 else '-'))
+
+# input: ranges array
+# output: the array formatted like the ranges table in importdata.py
+def format_ranges(bounds):
+    lines = ['(' + str(list(map(int, box[0]))) + ',' + str(list(map(int, box[1]))) + ')' for box in bounds]
+    return 'ranges = np.array([' + ',\n'.join(lines) + '])'
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spins', type=int, default=100, help='number of hand-labelled spins to score against')
+    parser.add_argument('--calibrate', action='store_true', help='search for better ranges')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    histograms = block_histograms(numspins=args.spins)
+    print('LOADED ' + str(len(histograms['labels'])) + ' BLOCK HISTOGRAMS (' + str(len(histograms['colors'])) +
+          ' COLOURS) IN ' + str(round(time.perf_counter() - start, 3)) + 'S')
+    start = time.perf_counter()
+    report = evaluate(histograms, importdata.ranges)
+    print('SCORED IN ' + str(round(1000 * (time.perf_counter() - start), 3)) + 'MS')
+    print_report(report)
+
+    if args.calibrate:
+        start = time.perf_counter()
+        bounds = calibrate(histograms)
+        print('CALIBRATED IN ' + str(round(time.perf_counter() - start, 2)) + 'S')
+        print_report(evaluate(histograms, bounds))
+        print(format_ranges(bounds))
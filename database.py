@@ -0,0 +1,217 @@
+# This class contains the storage layer shared by importdata.py and
+# runanalyses.py. Spins can live either on the MySQL server used for
+# the original analysis or in a local SQLite file, which lets the
+# whole pipeline run on a machine with no MySQL server. Both backends
+# hold the same spins table, so the payout query of
+# runanalyses.payline_query runs unchanged on either one.
+#
+# Connections are opened lazily, the first time get_connection is
+# called, and then kept for the rest of the process. Importing any
+# module of the project therefore never opens a socket, and every
+# worker process of a pool ends up with a connection of its own.
+
+import configparser
+import instrument
+import os
+import sqlite3
+import time
+
+# default SQLite database file, relative to the workspace
+sqlite_path = 'slots_data.db'
+
+# optional config file with a [database] section; any key can also be
+# set through an environment variable, e.g. SLOTS_DB_PASSWORD, which
+# takes precedence over the file
+config_path = 'slots.ini'
+defaults = {'backend': 'mysql', 'host': 'localhost', 'user': '<user>', 'password': '<password>',
+            'sqlite_path': sqlite_path}
+
+# open connections keyed by process id, the number of connections
+# opened and time spent acquiring them in this process, and the number
+# of batches SpinWriter has written to the spins table in it
+connections = {}
+stats = {'opened': 0, 'acquired': 0, 'acquire_time': 0.0, 'writes': 0}
+
+# rows buffered before each batched write
+batch_size = 500
+
+# input: path of the SQLite database file
+# output: sqlite3 connection
+#
+# Opens (or creates) the local SQLite database.
+def connect_sqlite(path=sqlite_path):
+    return sqlite3.connect(path)
+
+# input: config file path
+# output: dictionary of connection settings
+#
+# Merges the defaults, the config file and SLOTS_DB_* environment
+# variables, in increasing order of precedence.
+def load_config(path=config_path):
+    config = dict(defaults)
+    parser = configparser.ConfigParser()
+    if parser.read(path) and parser.has_section('database'):
+        config.update(parser['database'])
+    for key in defaults:
+        value = os.environ.get('SLOTS_DB_' + key.upper())
+        if value is not None:
+            config[key] = value
+    return config
+
+# input: backend and SQLite file overriding the configuration (optional)
+# output: database connection
+#
+# Hands out this process's connection, opening it on first use: one
+# per SQLite file, and one per MySQL server and user that is reopened
+# if it was closed or dropped. Every caller shares it, so no number of
+# calls can run out of connections. Connections are keyed on the
+# process id so a forked worker never reuses its parent's sockets.
+def get_connection(backend=None, path=None):
+    config = load_config()
+    if path is not None:
+        backend = 'sqlite'
+        config['sqlite_path'] = path
+    if backend is not None:
+        config['backend'] = backend
+
+    start = time.perf_counter()
+    if config['backend'] == 'sqlite':
+        key = (os.getpid(), 'sqlite', config['sqlite_path'])
+        if key not in connections:
+            connections[key] = connect_sqlite(config['sqlite_path'])
+            stats['opened'] = stats['opened'] + 1
+        connection = connections[key]
+    else:
+        key = (os.getpid(), 'mysql', config['host'], config['user'])
+        if key not in connections or not connections[key].is_connected():
+            import mysql.connector
+            connections[key] = mysql.connector.connect(
+                host=config['host'],
+                user=config['user'],
+                password=config['password']
+            )
+            stats['opened'] = stats['opened'] + 1
+        connection = connections[key]
+    stats['acquired'] = stats['acquired'] + 1
+    stats['acquire_time'] = stats['acquire_time'] + time.perf_counter() - start
+    return connection
+
+# input: N/A
+# output: string summarizing the connections used by this process
+def connection_stats():
+    return ('DB CONNECTIONS OPENED: ' + str(stats['opened']) + ', ACQUIRED: ' + str(stats['acquired']) +
+            ', ACQUIRE TIME: ' + str(round(stats['acquire_time'], 4)) + 'S')
+
+# input: database cursor
+# output: true if the cursor belongs to the SQLite backend
+def is_sqlite(dbcursor):
+    return isinstance(dbcursor, sqlite3.Cursor)
+
+# input: database cursor
+# output: N/A
+#
+# Selects the slots_data database. SQLite files hold a single
+# database, so there is nothing to select there.
+def use_database(dbcursor):
+    if not is_sqlite(dbcursor):
+        dbcursor.execute('USE slots_data')
+
+# input: database cursor
+# output: list of table names in slots_data
+#
+# Creates the database (MySQL only) and the spins table, leaving
+# either in place if it already exists so imports can be rerun.
+def create_tables(dbcursor):
+    if is_sqlite(dbcursor):
+        dbcursor.execute('CREATE TABLE IF NOT EXISTS spins (s INT(4), b1 INT(4), b2 INT(4), b3 INT(4), b4 INT(4), b5 INT(4), b6 INT(4), b7 INT(4), b8 INT(4), b9 INT(4))')
+        dbcursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    else:
+        dbcursor.execute('CREATE DATABASE IF NOT EXISTS slots_data')
+        dbcursor.execute('USE slots_data')
+        dbcursor.execute('CREATE TABLE IF NOT EXISTS spins (s INT(4), b1 INT(4), b2 INT(4), b3 INT(4), b4 INT(4), b5 INT(4), b6 INT(4), b7 INT(4), b8 INT(4), b9 INT(4))')
+        dbcursor.execute('SHOW TABLES')
+    return [table[0] for table in dbcursor.fetchall()]
+
+# input: database cursor
+# output: INSERT statement for one spin row in the backend's parameter style
+def insert_statement(dbcursor):
+    marker = '?' if is_sqlite(dbcursor) else '%s'
+    return 'INSERT INTO spins (s, b1, b2, b3, b4, b5, b6, b7, b8, b9) VALUES (' + ', '.join([marker] * 10) + ')'
+
+# input: database cursor
+# output: DELETE statement for the rows of one spin number
+def delete_statement(dbcursor):
+    return 'DELETE FROM spins WHERE s = ' + ('?' if is_sqlite(dbcursor) else '%s')
+
+# Buffers spin rows and writes them in batches, each batch being
+# one executemany (a single multi-row INSERT on MySQL) followed by
+# a single commit. In bulk mode the whole load is one transaction
+# that is committed on close, and SQLite skips its fsyncs while
+# loading; this is meant for large imports that can simply be
+# rerun if they are interrupted. In replace mode each batch first
+# deletes any rows with the same spin numbers, so writing a spin
+# twice leaves one row for it.
+class SpinWriter:
+
+    def __init__(self, dbcursor, batchsize=batch_size, bulk=False, replace=False):
+        self.dbcursor = dbcursor
+        self.batchsize = batchsize
+        self.bulk = bulk
+        self.replace = replace
+        self.statement = insert_statement(dbcursor)
+        self.rows = []
+        self.written = 0
+        self.pending = 0 # rows written but not yet committed
+        if bulk and is_sqlite(dbcursor):
+            dbcursor.execute('PRAGMA synchronous = OFF')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+    # input: spin row (s, b1, ..., b9)
+    # output: N/A
+    def add(self, row):
+        self.rows.append(tuple(row))
+        if len(self.rows) >= self.batchsize:
+            self.flush()
+
+    # input: N/A
+    # output: N/A
+    #
+    # Writes the buffered rows, committing unless in bulk mode.
+    def flush(self):
+        if self.rows:
+            if self.replace:
+                self.dbcursor.executemany(delete_statement(self.dbcursor), [(row[0],) for row in self.rows])
+            self.dbcursor.executemany(self.statement, self.rows)
+            if instrument.enabled:
+                instrument.add(rows=len(self.rows), queries=2 if self.replace else 1)
+            self.written = self.written + len(self.rows)
+            self.pending = self.pending + len(self.rows)
+            stats['writes'] = stats['writes'] + 1
+            self.rows = []
+        if not self.bulk:
+            self.commit()
+
+    # input: N/A
+    # output: N/A
+    def commit(self):
+        if self.pending:
+            self.dbcursor.execute('COMMIT')
+            self.pending = 0
+            if instrument.enabled:
+                instrument.add(queries=1)
+
+    # input: N/A
+    # output: N/A
+    #
+    # Writes anything still buffered and commits it.
+    def close(self):
+        self.flush()
+        self.commit()
+        if self.bulk and is_sqlite(self.dbcursor):
+            self.dbcursor.execute('PRAGMA synchronous = FULL')
@@ -0,0 +1,114 @@
+# This class contains a generator of synthetic spins, for testing the
+# analyses at a larger scale than the 1000 screenshotted spins. Spins
+# come from walking the reels with offsets and offsetweights exactly
+# as the machine does, so unlike the dataset every spin follows the
+# previous one. Each spin uses the same 9-block encoding (b1..b9) as
+# the spins table.
+#
+# Spins are produced in chunks of NumPy arrays and can be streamed to
+# any sink: the spins table (through database.SpinWriter), a .npy file,
+# a spin store (spinstore.py) or any function that takes arrays, such
+# as runanalyses.spin_payouts or backtest.backtest.
+
+import argparse
+import database
+import numpy as np
+import spinstore
+import time
+from runanalyses import offsets, offsetweights, reelwindow
+
+# spins generated per chunk
+chunk_size = 1 << 20
+
+# input: N/A
+# output: 8000x9 uint8 array of the blocks visible in every state
+def window_table():
+    return np.array([reelwindow(np.unravel_index(state, (20, 20, 20))) for state in range(8000)], dtype=np.uint8)
+
+# input: number of spins, seed, spins per chunk, offsets table, offset
+#        weights, starting reel indices (random if not given)
+# output: generator of Nx9 uint8 arrays of consecutive spins
+#
+# Draws the offset of every spin in a chunk at once, turns them into
+# reel indices with a cumulative sum and looks the nine blocks of each
+# state up in window_table. The last state of a chunk carries over to
+# the next, so the stream is consecutive across chunks.
+def generate_spins(numspins, seed=None, chunksize=chunk_size, offsetset=offsets, weights=offsetweights, start=None):
+    rng = np.random.default_rng(seed)
+    windows = window_table()
+    steps = np.array(offsetset, dtype=np.int64) % 20
+    bounds = np.cumsum(weights)
+    bounds = bounds / bounds[-1]
+    indices = np.array(start if start is not None else rng.integers(0, 20, size=3), dtype=np.int64)
+
+    for first in range(0, numspins, chunksize):
+        count = min(chunksize, numspins - first)
+        choice = np.minimum(np.searchsorted(bounds, rng.random(count), side='right'), len(steps) - 1)
+        positions = (indices + np.cumsum(steps[choice], axis=0)) % 20
+        indices = positions[-1]
+        yield windows[400 * positions[:, 0] + 20 * positions[:, 1] + positions[:, 2]]
+
+# input: database cursor, generator of spin chunks, rows per batch
+# output: number of spins written
+#
+# Appends the spins to the spins table in bulk, numbering them after
+# the last spin already there.
+def to_database(dbcursor, chunks, batchsize=database.batch_size):
+    database.use_database(dbcursor)
+    dbcursor.execute('SELECT MAX(s) FROM spins')
+    s = (dbcursor.fetchone()[0] or 0) + 1
+    with database.SpinWriter(dbcursor, batchsize, bulk=True) as writer:
+        for chunk in chunks:
+            for spin in chunk.tolist():
+                writer.add([s] + spin)
+                s = s + 1
+    return writer.written
+
+# input: path of the .npy file, number of spins, generator of spin chunks
+# output: number of spins written
+#
+# Writes the spins to a memory-mapped .npy file of shape numspins x 9,
+# one chunk at a time.
+def to_npy(path, numspins, chunks):
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(numspins, 9))
+    written = 0
+    for chunk in chunks:
+        out[written:written + len(chunk)] = chunk
+        written = written + len(chunk)
+    out.flush()
+    return written
+
+# input: path of the spin store, generator of spin chunks
+# output: number of spins written
+#
+# Appends the spins to a spin store, one chunk at a time.
+def to_store(path, chunks):
+    written = 0
+    for chunk in chunks:
+        spinstore.append(path, chunk)
+        written = written + len(chunk)
+    return written
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--spins', type=int, default=10000000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--npy', metavar='PATH', help='write the spins to a .npy file')
+    parser.add_argument('--sqlite', metavar='PATH', help='append the spins to the spins table of a SQLite file')
+    parser.add_argument('--store', metavar='PATH', help='append the spins to a spin store')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    chunks = generate_spins(args.spins, args.seed)
+    if args.npy:
+        count = to_npy(args.npy, args.spins, chunks)
+    elif args.store:
+        count = to_store(args.store, chunks)
+    elif args.sqlite:
+        count = to_database(database.get_connection(path=args.sqlite).cursor(), chunks)
+    else:
+        count = sum(len(chunk) for chunk in chunks)
+    elapsed = time.perf_counter() - start
+    print('GENERATED ' + str(count) + ' SPINS IN ' + str(round(elapsed, 2)) + 'S (' +
+          str(round(count / elapsed)) + ' SPINS/S)')
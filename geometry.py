@@ -0,0 +1,182 @@
+# This class contains the detection of where the reels sit in a
+# screenshot, so screenshots taken at any resolution can be labelled.
+# The crop box in importdata.py was measured by hand on 2560x1377
+# screenshots. Minecraft keeps the vertical field of view fixed, so at
+# any other resolution the reels are the same grid of square blocks,
+# scaled with the image height and centred on the crosshair; only the
+# amount of wall around them changes.
+#
+# The grid is found once per resolution: across the middle rows of the
+# screenshot the wall behind the reels is a single flat colour, so the
+# grid starts and ends where the pixels first differ from the ones at
+# the image edges. Its height is taken equal to its width, centred on
+# the image. The hand-measured crop box is then mapped from the grid of
+# the reference screenshots onto the detected one. The crop box of each
+# resolution is cached in memory and in a JSON file, so every later
+# screenshot of that size costs no detection at all.
+
+import cv2 as cv
+import json
+import numpy as np
+import os
+from PIL import Image
+
+# resolution the crop box was measured at, the crop box, and the reel
+# grid detected at that resolution
+reference_size = (2560, 1377)
+reference_crop = (632, 12, 1933, 1370)
+reference_grid = (610, 7, 1973, 1370)
+
+# crop boxes by 'WxH', in memory and on disk
+crops = {'2560x1377': list(reference_crop)}
+cache_path = 'geometry_cache.json'
+
+# grids detected so far by 'WxH' for resolutions met one screenshot at
+# a time, until there are enough of them to settle a crop box
+frame_grids = {}
+
+# screenshots sampled when detecting the grid of a new resolution
+samples = 5
+
+# cv.imread flags that decode at 1/1, 1/2, 1/4 and 1/8 of the size
+read_flags = {1: cv.IMREAD_COLOR, 2: cv.IMREAD_REDUCED_COLOR_2, 4: cv.IMREAD_REDUCED_COLOR_4,
+              8: cv.IMREAD_REDUCED_COLOR_8}
+
+# smallest side, in pixels, of a decoded block sample
+min_block = 32
+
+# input: image path
+# output: (width, height) read from the image header alone
+def image_size(path):
+    with Image.open(path) as img:
+        return img.size
+
+# input: HxWx3 image array
+# output: (x0, y0, x1, y1) of the reel grid
+#
+# Finds the grid's left and right edges in each of the middle rows as
+# the first pixels that differ from the wall colour at either end of
+# the row, and takes the median over the rows.
+def grid_bounds(img):
+    h, w = img.shape[:2]
+    band = img[int(0.4 * h):int(0.6 * h)].astype(np.int64)
+    left = (np.abs(band - band[:, :1]).sum(axis=2) > 24).argmax(axis=1)
+    right = w - (np.abs(band - band[:, -1:]).sum(axis=2) > 24)[:, ::-1].argmax(axis=1)
+    x0 = int(np.median(left))
+    x1 = int(np.median(right))
+    y0 = int(round((h - (x1 - x0)) / 2))
+    return (x0, y0, x1, y0 + x1 - x0)
+
+# input: (x0, y0, x1, y1) of a reel grid
+# output: crop box at the same place relative to that grid as the
+#         reference crop box is to the reference grid
+def crop_from_grid(grid):
+    scale = (grid[2] - grid[0]) / (reference_grid[2] - reference_grid[0])
+    return [int(round(grid[n % 2] + scale * (reference_crop[n] - reference_grid[n % 2]))) for n in range(4)]
+
+# input: list of image paths, all of the same resolution
+# output: crop box detected from them
+#
+# Takes the median grid over the images, so one screenshot taken while
+# the player was moving cannot skew it.
+def detect_crop(paths):
+    grids = [grid_bounds(cv.imread(path, cv.IMREAD_COLOR)) for path in paths]
+    return crop_from_grid([int(value) for value in np.median(np.array(grids), axis=0)])
+
+# input: cache file
+# output: N/A
+#
+# Adds the crop boxes cached on disk to the ones in memory.
+def load_cache(path=None):
+    path = cache_path if path is None else path
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            crops.update(json.load(f))
+
+# input: cache file
+# output: N/A
+def save_cache(path=None):
+    path = cache_path if path is None else path
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(crops, f, indent=1, sort_keys=True)
+    os.replace(temp, path)
+
+# input: list of image paths, cache file
+# output: dictionary of crop boxes by 'WxH' for every resolution among them
+#
+# Reads the header of every image and detects the crop box of each
+# resolution that is not cached yet from a few of its images, saving
+# the new ones to the cache.
+def prepare(paths, path=None):
+    load_cache(path)
+    unknown = {}
+    for image in paths:
+        size = image_size(image)
+        key = str(size[0]) + 'x' + str(size[1])
+        if key not in crops:
+            unknown.setdefault(key, []).append(image)
+    for key in unknown:
+        crops[key] = detect_crop(unknown[key][:samples])
+    if unknown:
+        save_cache(path)
+    return crops
+
+# input: image path, (width, height) of it, most images to return
+# output: list of the image and other images of the same resolution
+#         in its folder
+def same_size(path, size, limit=samples):
+    directory = os.path.dirname(path) or '.'
+    found = [path]
+    for item in sorted(os.scandir(directory), key=lambda item: item.name):
+        if len(found) >= limit:
+            break
+        if item.path == path or os.path.splitext(item.name)[1].lower() not in ('.png', '.jpg', '.jpeg'):
+            continue
+        try:
+            if image_size(item.path) == tuple(size):
+                found.append(item.path)
+        except OSError:
+            continue
+    return found
+
+# input: (width, height) of an image, path of the image
+# output: crop box of the reels at that resolution
+#
+# Falls back on the disk cache, then on detecting the grid from the
+# screenshot together with others of the same resolution from its
+# folder, as prepare would. One screenshot is not enough to trust, so
+# while fewer than samples of them exist every new one adds its grid
+# and the crop box is redone from the median; it is only kept and
+# saved once samples screenshots agree on it.
+def crop_for(size, path):
+    key = str(size[0]) + 'x' + str(size[1])
+    if key not in crops:
+        load_cache()
+    if key in crops:
+        return crops[key]
+    grids = frame_grids.setdefault(key, {})
+    for image in (same_size(path, size) if not grids else [path]):
+        if image not in grids:
+            grids[image] = grid_bounds(cv.imread(image, cv.IMREAD_COLOR))
+    crop = crop_from_grid([int(value) for value in np.median(np.array(list(grids.values())), axis=0)])
+    if len(grids) >= samples:
+        crops[key] = crop
+        del frame_grids[key]
+        save_cache()
+    return crop
+
+# input: image path, crop box
+# output: factor the image can be decoded smaller by
+#
+# Only JPEG decoders can skip detail while decoding; PNGs are always
+# decoded in full. The factor keeps every block sample at least
+# min_block pixels wide.
+def decode_scale(path, box):
+    if os.path.splitext(path)[1].lower() not in ('.jpg', '.jpeg'):
+        return 1
+    side = 100 * (box[2] - box[0]) / (reference_crop[2] - reference_crop[0])
+    scale = 1
+    while scale < 8 and side / (2 * scale) >= min_block:
+        scale = 2 * scale
+    return scale
@@ -9,34 +9,30 @@
 # Quantifying this data allows for further statistical analysis on a sample of
 # 1000 spins from the slot machine.
 
+import argparse
 import cv2 as cv
-import csv
 import numpy as np
+import manifest
 import os
-import mysql.connector
+import spinstore
+import time
+import database
+import geometry
+import instrument
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 
 # Workspace path
 root_dir = 'path/to/Minecraft-Slot-Machine'
 
-# mysql connection
-mydb = mysql.connector.connect(
-    host='localhost',
-    user='<user>',
-    password='<password>'
-)
-
 # input: mysql cursor
 # output: N/A
 #
 # initializes a database and table to import the slot machine
 # spins.
 def init_database(dbcursor):
-    dbcursor.execute('CREATE DATABASE slots_data')
-    dbcursor.execute('USE slots_data')
-    dbcursor.execute('CREATE TABLE spins (s INT(4), b1 INT(4), b2 INT(4), b3 INT(4), b4 INT(4), b5 INT(4), b6 INT(4), b7 INT(4), b8 INT(4), b9 INT(4))')
-    dbcursor.execute('SHOW TABLES')
-    for test in dbcursor:
+    for test in database.create_tables(dbcursor):
         print(test)
 
 # input: raw image path, cropped images path
@@ -45,21 +41,25 @@ def init_database(dbcursor):
 # Takes each raw image from minecraft's screenshots folder and
 # splits it into nine images of each respective block in the spin. The convention
 # used to index blocks is left-to-right, starting with the top left block.
+@instrument.stage('split_image')
 def split_image(img_num, path):
 
     #format raw image
     raw_img = Image.open('raw_images/spin (' + str(img_num) + ").png")
-    cropped_img = raw_img.crop((632, 12, 1933, 1370)) # these values differ over other resolutions
+    if instrument.enabled:
+        instrument.add(rows=1, nbytes=os.path.getsize(raw_img.filename))
+    cropped_img = raw_img.crop(tuple(geometry.crop_for(raw_img.size, raw_img.filename)))
 
     #create unique dir for sample
     spin_path = os.path.join(path, 's' + str(img_num))
-    os.mkdir(spin_path)
+    os.makedirs(spin_path, exist_ok=True)
 
     #save new elements, partitioned into 9 blocks
     w, h = cropped_img.size
+    inset = 100 * w / (geometry.reference_crop[2] - geometry.reference_crop[0])
     for i in range(3):
         for j in range(3):
-            block = cropped_img.crop((j*w/3 + 100, i*h/3 + 100, j*w/3 + 200, i*h/3 + 200))
+            block = cropped_img.crop((j*w/3 + inset, i*h/3 + inset, j*w/3 + 2*inset, i*h/3 + 2*inset))
             block.save(spin_path + "/b" + str(3*i + j + 1) + '.png')
 
 # this structure defines the lower and upper bounds of RGB values for each block, organized
@@ -74,101 +74,323 @@ ranges = np.array([([62,37,107],[107,82,153]), # amethyst (A)
 ([43,41,43],[61,58,61]), # netherite (N)
 ([59,111,12],[128,174,78])]) # clover (C)
 
-# input: image path
-# output: indexed label in range [0,7]
+# input: ranges array (defaults to the table above)
+# output: 3x256 array of label bitmasks, one row per RGB channel
+#
+# Precomputes the ranges boxes into a per-channel lookup table. Bit
+# n of lut[c][v] is set when value v of channel c falls inside the
+# bounds of label n, so a pixel lands in box n exactly when bit n is
+# set in lut[0][r] & lut[1][g] & lut[2][b]. Since the boxes are
+# axis-aligned this is the same test cv.inRange makes, but for all
+# eight labels at once.
+def build_lookup_table(bounds=ranges):
+    lut = np.zeros((3, 256), dtype=np.uint8)
+    values = np.arange(256)
+    for index in range(len(bounds)):
+        for channel in range(3):
+            inside = (values >= bounds[index][0][channel]) & (values <= bounds[index][1][channel])
+            lut[channel][inside] |= np.uint8(1 << index)
+    return lut
+
+# bitmask -> label membership, used to turn a bincount over
+# the 256 possible bitmasks into per-label pixel votes
+bitcounts = np.array([[(mask >> index) & 1 for index in range(8)] for mask in range(256)], dtype=np.int64)
+
+# built once at import; rebuild with build_lookup_table if ranges changes
+lookup_table = build_lookup_table()
+
+# input: RGB block (HxWx3) or stack of blocks (NxHxWx3), optional lookup table
+# output: array of labels in range [-1,7] and array of per-label pixel votes
 #
-# Masks each image from the dataset for each block and returns
-# the index of the correct label.
-def label_image(path):
+# Labels every block in one vectorized pass over its pixels. Each
+# pixel is reduced to its label bitmask through the lookup table, then
+# a single bincount per stack gives the number of pixels that fall
+# inside each label's range. The label with the most votes wins and
+# ties go to the lowest index, matching the original masking loop;
+# blocks with no votes at all are labelled -1.
+@instrument.stage('classify_blocks')
+def classify_blocks(blocks, lut=None):
+    if lut is None:
+        lut = lookup_table
+    blocks = np.asarray(blocks)
+    single = blocks.ndim == 3
+    if single:
+        blocks = blocks[np.newaxis]
+    n = blocks.shape[0]
+
+    masks = lut[0][blocks[..., 0]] & lut[1][blocks[..., 1]] & lut[2][blocks[..., 2]]
+    offsets = (np.arange(n, dtype=np.int64) * 256).reshape((n,) + (1,) * (masks.ndim - 1))
+    histogram = np.bincount((masks + offsets).ravel(), minlength=n * 256).reshape(n, 256)
+    votes = histogram @ bitcounts
+
+    labels = np.argmax(votes, axis=1)
+    labels[votes.max(axis=1) == 0] = -1
+    if single:
+        return labels[0], votes[0]
+    return labels, votes
+
+# input: image path, whether to also return the pixel votes
+# output: indexed label in range [0,7] (and its per-label votes)
+#
+# Reads a block from the dataset and labels it with
+# classify_blocks.
+@instrument.stage('label_image')
+def label_image(path, withvotes=False):
 
     # read image and convert to rgb
     img = cv.imread(path)
+    if instrument.enabled:
+        instrument.add(rows=1, nbytes=os.path.getsize(path))
     rgbimg = cv.cvtColor(img, cv.COLOR_BGR2RGB)
 
-    max = 0 # min average = 0 if no pixels land in specified threshold
-    label = -1
-    for index in range(8):
-        # mask image and compute average over all channels
-        mask = cv.inRange(rgbimg, ranges[index][0],ranges[index][1])
-        average = np.mean(np.array(cv.mean(mask)))
-        
-        # record index of masked image with highest average (most white pixels)
-        if average > max:
-            label = index
-            max = average
-
-    return label 
-
-# input: N/A
-# output: N/A
+    label, votes = classify_blocks(rgbimg)
+    if withvotes:
+        return int(label), votes
+    return int(label)
+
+# input: ranges array (defaults to the table above)
+# output: fraction of the hand-labelled blocks labelled correctly
 #
 # I manually wrote down labels for the first 100 spins in this
 # sample, and this method compares those values with the labels
-# returned from label_image.
-def test_correctness():
-    errors = 0
-    for spin in range(100):
-        filepath = root_dir + '/dataset/s' + str(spin + 1)
-        with open(filepath + '/labels.csv', 'r', encoding='utf-8') as csvFile:
-            reader = csv.DictReader(csvFile)
-            for row in reader:
-                label = int(label_image(filepath + '/b' + str(row['Block']) + '.png'))
-                error = 0
-
-                #switch case to compare index with CSV label
-                if label == 0 and row[' Label'] != ' A':
-                    error = 1
-                elif label == 1 and row[' Label'] != ' I':
-                    error = 1
-                elif label == 2 and row[' Label'] != ' R':
-                    error = 1
-                elif label == 3 and row[' Label'] != ' G':
-                    error = 1
-                elif label == 4 and row[' Label'] != ' E':
-                    error = 1
-                elif label == 5 and row[' Label'] != ' D':
-                    error = 1
-                elif label == 6 and row[' Label'] != ' N':
-                    error = 1
-                elif label == 7 and row[' Label'] != ' C':
-                    error = 1
-                if error:
-                    print('ERROR (spin ' + str(spin + 1) + ', block ' + str(row['Block']) + ')')
-                    print(row)
-                    print(label)
-                    errors = errors + 1
-    
-    accuracy = float(900-errors) / float(900)
-    return accuracy
+# the ranges give them, printing the confusion matrix and every block
+# labelled wrong. The blocks are scored through their cached colour
+# histograms (see calibrate.py), which gives the same votes as
+# label_image without decoding them again.
+@instrument.stage('test_correctness')
+def test_correctness(bounds=ranges):
+    import calibrate
+    report = calibrate.evaluate(calibrate.block_histograms(root_dir), bounds)
+    calibrate.print_report(report)
+    return report['accuracy']
 
-# input: mysql cursor
-# output: N/A
-# 
-# Uses label_image for all blocks to organize and import all data
-# into an SQL server. Each block is labelled by the decimal value of its binary
-# representation in the game.
-def import_spins(dbcursor):
-    dbcursor.execute('USE slots_data')
-    entry = {'s': 0, 'b1':-1, 'b2':-1, 'b3':-1, 'b4':-1, 'b5':-1, 'b6':-1, 'b7':-1, 'b8':-1, 'b9':-1}
-
-    #iterate over all spins
-    for s in range(1000):
-        entry['s'] = s + 1
+# crop box of the reels within a 2560x1377 screenshot; other
+# resolutions get theirs from geometry.py
+crop_box = geometry.reference_crop
+
+# input: crop box of the reels in the raw screenshot, factor the
+#        screenshot was decoded smaller by
+# output: list of nine (x0, y0, x1, y1) block boxes in decoded image coordinates
+#
+# Makes the same partition as split_image, rounding each box the
+# way PIL's crop does, so the streamed blocks are pixel-identical to
+# the ones saved in the dataset. The 100 pixel insets scale with the
+# crop box at other resolutions.
+def block_boxes(box=crop_box, scale=1):
+    w = box[2] - box[0]
+    h = box[3] - box[1]
+    inset = 100 * w / (geometry.reference_crop[2] - geometry.reference_crop[0])
+    side = round(round(inset) / scale)
+    boxes = []
+    for i in range(3):
+        for j in range(3):
+            x0 = round((box[0] + round(j*w/3 + inset)) / scale)
+            y0 = round((box[1] + round(i*h/3 + inset)) / scale)
+            boxes.append((x0, y0, x0 + side, y0 + side))
+    return boxes
+
+# input: raw image number, workspace path, cropped images path (optional),
+#        raw image path (defaults to raw_images/spin (N).png)
+# output: spin row (s, b1, ..., b9)
+#
+# Decodes one screenshot, slices the nine blocks out as views of
+# the decoded array and labels them together. The crop box comes
+# from geometry.py for the screenshot's resolution, and JPEG
+# screenshots are decoded at a reduced size when the blocks allow it.
+# Passing a path for the cropped images saves each block as well, the
+# same layout split_image produces; this is only useful for debugging
+# labels.
+@instrument.stage('label_spin')
+def label_spin(img_num, workspace, blockpath=None, path=None):
+    if path is None:
+        path = os.path.join(workspace, 'raw_images', 'spin (' + str(img_num) + ').png')
+    box = geometry.crop_for(geometry.image_size(path), path)
+    scale = geometry.decode_scale(path, box)
+    img = cv.imread(path, geometry.read_flags[scale])
+    if instrument.enabled:
+        instrument.add(rows=1, nbytes=os.path.getsize(path))
+
+    # BGR -> RGB by reversing the channel axis of each view
+    blocks = [img[y0:y1, x0:x1, ::-1] for (x0, y0, x1, y1) in block_boxes(box, scale)]
+    labels, votes = classify_blocks(np.stack(blocks))
+
+    if blockpath is not None:
+        spin_path = os.path.join(blockpath, 's' + str(img_num))
+        os.makedirs(spin_path, exist_ok=True)
         for b in range(9):
-            path = root_dir + '/dataset/s' + str(s + 1) + '/b' + str(b+1) + '.png'
-            key = 'b' + str(b+1)
-            entry[key] = label_image(path)
-        
-        cmd = 'INSERT INTO spins (s, b1, b2, b3, b4, b5, b6, b7, b8, b9) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'
-        dbcursor.execute(cmd, (entry['s'], entry['b1'], entry['b2'], entry['b3'], entry['b4'], entry['b5'], entry['b6'], entry['b7'], entry['b8'], entry['b9']))
-        mydb.commit()
+            cv.imwrite(spin_path + '/b' + str(b + 1) + '.png', blocks[b][:, :, ::-1])
+
+    return (img_num,) + tuple(int(label) for label in labels)
+
+# input: raw image numbers, number of worker processes, cropped images path
+#        (optional), dictionary of raw image paths by number (optional)
+# output: generator of spin rows (s, b1, ..., b9), in order
+#
+# Streams every screenshot through label_spin without writing
+# intermediate files. Work fans out over a process pool, but only
+# a bounded number of screenshots are in flight at once so memory
+# stays flat no matter how many spins are imported. The throughput
+# is printed once the stream is exhausted.
+def stream_spins(img_nums, workers=1, blockpath=None, paths={}):
+    start = time.perf_counter()
+    count = 0
+    img_nums = list(img_nums)
+    geometry.prepare([paths.get(img_num, os.path.join(root_dir, 'raw_images', 'spin (' + str(img_num) + ').png'))
+                      for img_num in img_nums])
+    if workers <= 1:
+        for img_num in img_nums:
+            yield label_spin(img_num, root_dir, blockpath, paths.get(img_num))
+            count = count + 1
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for img_num in img_nums:
+                pending.append(instrument.submit(pool, label_spin, img_num, root_dir, blockpath, paths.get(img_num)))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+                    count = count + 1
+            while pending:
+                yield pending.popleft().result()
+                count = count + 1
+
+    elapsed = time.perf_counter() - start
+    print('LABELLED ' + str(count) + ' SPINS IN ' + str(round(elapsed, 2)) + 'S (' +
+          str(round(count / elapsed, 1) if elapsed > 0 else 0) + ' SPINS/S)')
+
+# imports of at least this many spins use the bulk-load path
+bulk_threshold = 10000
+
+# input: database cursor, iterable of spin rows (defaults to streaming all
+#        1000 raw images), rows per batch, whether to bulk load, whether
+#        to replace rows with the same spin numbers
+# output: number of spins imported
+# 
+# Imports the labelled spins into the database in batches, with a
+# single commit per batch (or per import when bulk loading). Each block
+# is labelled by the decimal value of its binary representation in the game.
+@instrument.stage('import_spins')
+def import_spins(dbcursor, rows=None, batchsize=database.batch_size, bulk=False, replace=False):
+    database.use_database(dbcursor)
+    if rows is None:
+        rows = stream_spins(range(1, 1001))
+
+    with database.SpinWriter(dbcursor, batchsize, bulk, replace) as writer:
+        for entry in rows:
+            writer.add(entry)
+    return writer.written
+
+# input: manifest path, manifest dictionary, entries to import from
+#        manifest.scan, function writing and committing a list of spin
+#        rows, number of worker processes, rows per batch, cropped images
+#        path (optional)
+# output: number of spins imported
+#
+# Labels the raw images listed in pending and hands them to write a
+# batch at a time. The manifest is saved after every batch, so an
+# interrupted import picks up from the last batch written.
+@instrument.stage('ingest')
+def ingest(manifestpath, state, pending, write, workers=1, batchsize=database.batch_size, blockpath=None):
+    directory = os.path.join(root_dir, 'raw_images')
+    entries = {entry['spin']: entry for entry in pending}
+    paths = {entry['spin']: os.path.join(directory, entry['name']) for entry in pending}
+    batch = []
+    for row in stream_spins(list(entries), workers, blockpath, paths):
+        batch.append(row)
+        if len(batch) >= batchsize:
+            commit_batch(manifestpath, state, entries, write, batch)
+            batch = []
+    if batch:
+        commit_batch(manifestpath, state, entries, write, batch)
+    return len(entries)
+
+# input: database cursor, manifest path, manifest dictionary, entries
+#        to import from manifest.scan, number of worker processes, rows
+#        per batch, cropped images path (optional)
+# output: number of spins imported
+#
+# Bulk-load version of ingest for large imports into the spins table:
+# every spin is written in one transaction and the manifest is saved
+# once it is committed, so an interrupted import writes nothing and is
+# redone in full by the next run.
+@instrument.stage('bulk_ingest')
+def bulk_ingest(dbcursor, manifestpath, state, pending, workers=1, batchsize=database.batch_size, blockpath=None):
+    directory = os.path.join(root_dir, 'raw_images')
+    entries = {entry['spin']: entry for entry in pending}
+    paths = {entry['spin']: os.path.join(directory, entry['name']) for entry in pending}
+
+    def recorded():
+        for row in stream_spins(list(entries), workers, blockpath, paths):
+            manifest.record(state, entries[row[0]], row)
+            yield row
+
+    count = import_spins(dbcursor, recorded(), batchsize, bulk=True, replace=True)
+    manifest.save(manifestpath, state)
+    return count
+
+# input: manifest path, manifest dictionary, entries by spin number,
+#        writing function, list of spin rows
+# output: N/A
+#
+# Writes one batch, then records it in the manifest.
+def commit_batch(manifestpath, state, entries, write, batch):
+    write(batch)
+    for row in batch:
+        manifest.record(state, entries[row[0]], row)
+    manifest.save(manifestpath, state)
+
+# input: database cursor, list of spin rows
+# output: N/A
+#
+# Writes the rows to the spins table, replacing any rows with the same
+# spin numbers, and commits them.
+@instrument.stage('write_spins')
+def write_spins(dbcursor, rows):
+    with database.SpinWriter(dbcursor, len(rows), replace=True) as writer:
+        for row in rows:
+            writer.add(row)
 
 # main driver; I used this interchangeably with the
 # interpreter for debugging
 if __name__ == '__main__':
-    for img_num in range(1000):
-        split_image(img_num + 1, os.path.join(root_dir, 'dataset'))
-    accuracy = test_correctness()
-    print(accuracy)
-    init_database(mydb.cursor())
-    import_spins(mydb.cursor())
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes used to label screenshots')
+    parser.add_argument('--save-blocks', action='store_true', help='also write the cropped blocks to dataset/')
+    parser.add_argument('--sqlite', metavar='PATH', help='import into a local SQLite file instead of MySQL')
+    parser.add_argument('--batch-size', type=int, default=database.batch_size, help='spins written per commit')
+    parser.add_argument('--spins', type=int, default=None, help='only import raw images up to this spin number')
+    parser.add_argument('--store', metavar='PATH', help='import into a spin store instead of the spins table')
+    parser.add_argument('--manifest', metavar='PATH', help='manifest of imported raw images (defaults to one next to the target)')
+    instrument.add_argument(parser)
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrument.enable()
+
+    # only raw images that are new or changed since the last run are imported
+    target = args.store or args.sqlite or os.path.join(root_dir, 'slots_data')
+    manifestpath = args.manifest or target + '.manifest.json'
+    state = manifest.load(manifestpath)
+    pending, touched = manifest.scan(os.path.join(root_dir, 'raw_images'), state)
+    if touched:
+        manifest.save(manifestpath, state)
+    if args.spins is not None:
+        pending = [entry for entry in pending if entry['spin'] <= args.spins]
+    if not pending:
+        print('NOTHING TO IMPORT, ' + str(len(state['files'])) + ' RAW IMAGES UP TO DATE')
+    else:
+        accuracy = test_correctness()
+        print(accuracy)
+        blockpath = os.path.join(root_dir, 'dataset') if args.save_blocks else None
+        if args.store:
+            write = lambda rows: spinstore.put(args.store, rows)
+        else:
+            db = database.get_connection(path=args.sqlite)
+            init_database(db.cursor())
+            write = lambda rows: write_spins(db.cursor(), rows)
+        if not args.store and len(pending) >= bulk_threshold:
+            count = bulk_ingest(db.cursor(), manifestpath, state, pending, args.workers, args.batch_size, blockpath)
+        else:
+            count = ingest(manifestpath, state, pending, write, args.workers, args.batch_size, blockpath)
+        print('IMPORTED ' + str(count) + ' NEW OR CHANGED SPINS INTO ' + target)
+        if not args.store:
+            print(database.connection_stats())
+    instrument.finish(args.profile)
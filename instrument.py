@@ -0,0 +1,194 @@
+# This class contains the timing and counter instrumentation of the
+# import and analysis pipelines. Functions are marked as stages with the
+# stage decorator, which returns them untouched: until enable is called
+# nothing is wrapped, so a disabled run executes exactly the same code
+# as before. Counters inside a stage are guarded by `if
+# instrument.enabled:`, which costs one attribute lookup.
+#
+# enable swaps every marked function for a wrapper in its module, so
+# calls made through the module (which is how the project calls its own
+# functions) are timed. Each stage records:
+#   -calls and total wall time
+#   -rows processed, bytes read and database round trips, added with
+#    add() by the code running inside the stage
+# and every call is kept as a complete event, which the Chrome trace
+# viewer or Perfetto can display.
+#
+# Work sent to a process pool through submit or pool_map runs in the worker
+# with instrumentation enabled there too; the worker's stages come back
+# with each result and are merged into this process's.
+
+import functools
+import json
+import os
+import sys
+import time
+
+enabled = False
+
+# stage totals by name, the stages currently running (innermost last)
+# and the complete events recorded
+stats = {}
+stack = []
+events = []
+
+# every function marked as a stage: (module name, function name, stage name)
+registry = []
+
+# most events kept; later calls are still counted in stats
+max_events = 1000000
+
+# input: stage name
+# output: decorator marking a function as that stage
+def stage(name):
+    def mark(function):
+        registry.append((function.__module__, function.__name__, name))
+        return wrap(function, name) if enabled else function
+    return mark
+
+# input: function, stage name
+# output: function timing every call of the original as that stage
+def wrap(function, name):
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        stack.append(name)
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            stack.pop()
+            record = totals(name)
+            record['calls'] = record['calls'] + 1
+            record['time'] = record['time'] + elapsed / 1e9
+            if len(events) < max_events:
+                events.append({'name': name, 'ph': 'X', 'ts': start / 1000, 'dur': elapsed / 1000,
+                               'pid': os.getpid(), 'tid': 0})
+    timed.original = function
+    return timed
+
+# input: stage name
+# output: the stage's totals, created empty if needed
+def totals(name):
+    if name not in stats:
+        stats[name] = {'calls': 0, 'time': 0.0, 'rows': 0, 'bytes': 0, 'queries': 0}
+    return stats[name]
+
+# input: N/A
+# output: N/A
+#
+# Turns instrumentation on for this process, wrapping every stage
+# marked so far.
+def enable():
+    global enabled
+    enabled = True
+    for modulename, functionname, name in registry:
+        module = sys.modules.get(modulename)
+        function = getattr(module, functionname, None)
+        if function is not None and not hasattr(function, 'original'):
+            setattr(module, functionname, wrap(function, name))
+
+# input: N/A
+# output: N/A
+#
+# Clears the recorded stages and events.
+def reset():
+    stats.clear()
+    events.clear()
+
+# input: rows processed, bytes read, database round trips
+# output: N/A
+#
+# Adds to the counters of the innermost running stage.
+def add(rows=0, nbytes=0, queries=0):
+    record = totals(stack[-1] if stack else 'other')
+    record['rows'] = record['rows'] + rows
+    record['bytes'] = record['bytes'] + nbytes
+    record['queries'] = record['queries'] + queries
+
+# input: stages and events recorded by another process
+# output: N/A
+def merge(snapshot):
+    for name, other in snapshot['stats'].items():
+        record = totals(name)
+        for key in record:
+            record[key] = record[key] + other[key]
+    events.extend(snapshot['events'][:max_events - len(events)])
+
+# input: function, tuple of arguments
+# output: (result, stages and events recorded while computing it)
+#
+# Runs one pool task with instrumentation enabled, starting from empty
+# totals so a forked worker does not send back its parent's.
+def run_task(function, args):
+    enable()
+    reset()
+    # a spawned worker unpickles the unwrapped function; use the wrapper
+    function = getattr(sys.modules.get(function.__module__), function.__name__, function)
+    result = function(*args)
+    return result, {'stats': dict(stats), 'events': list(events)}
+
+# Future returned by submit when instrumentation is enabled; its result
+# is the task's own, with the worker's stages merged in on the way.
+class TaskFuture:
+
+    def __init__(self, future):
+        self.future = future
+
+    def result(self, timeout=None):
+        result, snapshot = self.future.result(timeout)
+        merge(snapshot)
+        return result
+
+# input: process pool, function, arguments
+# output: future of function(*args)
+def submit(pool, function, *args):
+    if not enabled:
+        return pool.submit(function, *args)
+    return TaskFuture(pool.submit(run_task, function, args))
+
+# input: process pool, function, iterables of arguments
+# output: iterator of the results, in order
+def pool_map(pool, function, *iterables):
+    if not enabled:
+        return pool.map(function, *iterables)
+    return (TaskFuture(future).result() for future in
+            [pool.submit(run_task, function, args) for args in zip(*iterables)])
+
+# input: N/A
+# output: string of the summary table, slowest stage first
+def summary():
+    lines = ['STAGE'.ljust(24) + 'CALLS'.rjust(10) + 'TIME (S)'.rjust(12) + 'ROWS'.rjust(12) +
+             'BYTES READ'.rjust(14) + 'DB TRIPS'.rjust(10)]
+    for name in sorted(stats, key=lambda name: -stats[name]['time']):
+        record = stats[name]
+        lines.append(name.ljust(24) + str(record['calls']).rjust(10) + format(record['time'], '.4f').rjust(12) +
+                     str(record['rows']).rjust(12) + str(record['bytes']).rjust(14) + str(record['queries']).rjust(10))
+    return '\n'.join(lines)
+
+# input: file path
+# output: N/A
+#
+# Writes the stage totals and the events to one JSON file. The events
+# are under traceEvents, so the file also opens in the Chrome trace
+# viewer or Perfetto, which ignore the other keys.
+def write(path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'stages': stats, 'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+# input: argument parser
+# output: N/A
+#
+# Adds the --profile option shared by the main drivers.
+def add_argument(parser):
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='PATH',
+                        help='time each stage and print a summary; with a path, also write the stages and trace events as JSON')
+
+# input: value of the --profile option
+# output: N/A
+def finish(profile):
+    if profile is None:
+        return
+    print(summary())
+    if profile:
+        write(profile)
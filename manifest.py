@@ -0,0 +1,109 @@
+# This class contains the manifest that makes importdata.py
+# incremental. The manifest is a JSON file recording every raw image
+# that has been imported: its size, modification time and SHA-1 hash,
+# the spin number it was imported as and the nine labels it got.
+#
+# A run only labels the raw images that are new or whose contents
+# changed since they were recorded. Files whose size and modification
+# time match the manifest are not even read, so rescanning an
+# unchanged folder costs one stat per file. A file that was touched
+# but not changed is recognised by its hash and only has its
+# modification time updated.
+#
+# The manifest is saved after each batch of spins has been committed,
+# and writing a spin again replaces it (see database.SpinWriter and
+# spinstore.put). A run that stops partway through therefore resumes
+# from its last saved batch, redoing at most that batch.
+
+import hashlib
+import json
+import os
+import re
+
+version = 1
+
+# raw images named like this are imported as spin N
+name_pattern = re.compile(r'^spin \((\d+)\)\.png$')
+
+# input: file path
+# output: SHA-1 hex digest of the file's contents
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+# input: manifest path
+# output: manifest dictionary (empty if the file does not exist yet)
+def load(path):
+    if not os.path.exists(path):
+        return {'version': version, 'files': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if state.get('version') != version:
+        raise ValueError(path + ' has an unsupported manifest version')
+    return state
+
+# input: manifest path, manifest dictionary
+# output: N/A
+#
+# Writes the manifest to a temporary file and moves it over the old
+# one, so a crash never leaves a half-written manifest.
+def save(path, state):
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+# input: directory of raw images, manifest dictionary
+# output: list of entries to import, ordered by spin number, and the
+#         number of recorded files whose modification time was updated
+#
+# Compares the .png files in the directory with the manifest. Each
+# entry to import holds the file's name, size, modification time,
+# hash and spin number. A changed file keeps its spin number; a new
+# one is numbered from its name when it follows the spin (N).png
+# convention and that number is free, else after the highest spin
+# number known.
+def scan(directory, state):
+    files = state['files']
+    pending = []
+    touched = 0
+    for item in os.scandir(directory):
+        if not item.is_file() or not item.name.lower().endswith('.png'):
+            continue
+        stat = item.stat()
+        recorded = files.get(item.name)
+        if recorded and recorded['size'] == stat.st_size and recorded['mtime'] == stat.st_mtime_ns:
+            continue
+
+        digest = file_hash(item.path)
+        if recorded and recorded['size'] == stat.st_size and recorded['sha1'] == digest:
+            recorded['mtime'] = stat.st_mtime_ns
+            touched = touched + 1
+            continue
+        pending.append({'name': item.name, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': digest,
+                        'spin': recorded['spin'] if recorded else None})
+
+    # number the new files
+    owners = {files[name]['spin']: name for name in files}
+    for entry in pending:
+        match = name_pattern.match(entry['name'])
+        if entry['spin'] is None and match and int(match.group(1)) not in owners:
+            entry['spin'] = int(match.group(1))
+            owners[entry['spin']] = entry['name']
+    for entry in sorted(pending, key=lambda entry: entry['name']):
+        if entry['spin'] is None:
+            entry['spin'] = max(owners, default=0) + 1
+            owners[entry['spin']] = entry['name']
+
+    pending.sort(key=lambda entry: entry['spin'])
+    return pending, touched
+
+# input: manifest dictionary, entry from scan, spin row (s, b1, ..., b9)
+# output: N/A
+def record(state, entry, row):
+    state['files'][entry['name']] = dict(entry, labels=[int(label) for label in row[1:]])
@@ -0,0 +1,176 @@
+# This class contains an exact analysis of the reel states, as an
+# alternative to simulating them with test_combinations. The machine
+# is a Markov chain on the 8000 states (i, j, k) of the three reels:
+# every spin adds one of the offsets triples mod 20 with its weight in
+# offsetweights. Since the same offsets apply from every state, the
+# chain is a random walk on Z20^3, which gives the following exactly:
+#   -the reachable states are the subgroup generated by the offsets
+#   -every state has incoming probability 1, so the stationary
+#    distribution is uniform over the reachable states
+#   -expected hitting times follow from the fundamental matrix, which
+#    the 3d Fourier transform diagonalizes
+#   -the payout probabilities of every line are the fraction of
+#    reachable states that pay it
+# The chain is periodic for the shipped offsets (period 20): the state
+# after n spins stays confined to one class of states per phase and its
+# distribution never converges. The stationary distribution and the
+# payout probabilities are therefore long-run frequencies, averaged
+# over many spins, not the odds of any one spin.
+# Cover times have no closed form, so Matthews' bounds are reported
+# for them; montecarlo.py gives their full distribution.
+
+import argparse
+import time
+import numpy as np
+from runanalyses import offsets, offsetweights, compareline, compareclover, paylines, reelwindow
+
+# transition tables already built, keyed by offsets and weights
+transitions = {}
+
+# input: offsets table, offset weights
+# output: (8000x4 array of next states, array of the 4 probabilities)
+#
+# Builds the sparse 8000x8000 transition matrix once per offsets set.
+# Each state has exactly one successor per offset, so row s of the
+# matrix is stored as the states next[s] with probabilities probs;
+# state (i, j, k) is numbered 400i + 20j + k as in test_combinations.
+def transition_matrix(offsetset=offsets, weights=offsetweights):
+    key = (tuple(tuple(offset) for offset in offsetset), tuple(weights))
+    if key not in transitions:
+        transitions[key] = (next_states(offsetset), np.array(weights, dtype=float))
+    return transitions[key]
+
+# input: offsets table
+# output: 8000xN array of the state each offset leads to from each state
+def next_states(offsetset):
+    i, j, k = np.unravel_index(np.arange(8000), (20, 20, 20))
+    steps = np.array(offsetset) % 20
+    return (400 * ((i[:, np.newaxis] + steps[:, 0]) % 20) +
+            20 * ((j[:, np.newaxis] + steps[:, 1]) % 20) +
+            (k[:, np.newaxis] + steps[:, 2]) % 20)
+
+# input: transition table, starting state
+# output: boolean array of reachable states, array of BFS levels
+#
+# Breadth-first search over the states reachable from start through
+# offsets of non-zero weight.
+def reachable_states(nextstates, probs, start=0):
+    nextstates = nextstates[:, probs > 0]
+    level = np.full(8000, -1)
+    level[start] = 0
+    frontier = np.array([start])
+    depth = 0
+    while len(frontier):
+        depth = depth + 1
+        candidates = np.unique(nextstates[frontier].ravel())
+        frontier = candidates[level[candidates] < 0]
+        level[frontier] = depth
+    return level >= 0, level
+
+# input: transition table, BFS levels from reachable_states
+# output: period of the chain on the reachable states
+#
+# The period is the gcd of level[u] + 1 - level[v] over every
+# transition u -> v between reachable states.
+def periodicity(nextstates, probs, level):
+    nextstates = nextstates[:, probs > 0]
+    reached = level >= 0
+    gaps = level[reached][:, np.newaxis] + 1 - level[nextstates[reached]]
+    return int(np.gcd.reduce(np.abs(gaps).ravel()))
+
+# input: offsets table, offset weights, boolean array of the states
+#        reachable from (0,0,0) (optional, found with reachable_states)
+# output: 20x20x20 array of expected spins to first reach each state
+#         from (0,0,0) (inf where unreachable)
+#
+# For a random walk with step distribution mu, the hitting time from
+# 0 to g is |H| (z(0) - z(g)), where H is the reachable subgroup and z
+# is the Green's function whose Fourier transform is 1 / (1 - mu^(x))
+# over the characters where mu^(x) != 1. The time to return to (0,0,0)
+# is reported at index (0,0,0) and equals |H|.
+def hitting_times(offsetset=offsets, weights=offsetweights, reached=None):
+    mu = np.zeros((20, 20, 20))
+    for offset, weight in zip(offsetset, weights):
+        mu[offset[0] % 20, offset[1] % 20, offset[2] % 20] += weight
+
+    muhat = np.fft.fftn(mu)
+    trivial = np.abs(1 - muhat) < 1e-9
+    zhat = np.where(trivial, 0, 1 / np.where(trivial, 1, 1 - muhat))
+    z = np.fft.ifftn(zhat).real
+
+    size = 8000 // int(trivial.sum())
+    if reached is None:
+        reached, level = reachable_states(*transition_matrix(offsetset, weights))
+    times = size * (z[0, 0, 0] - z)
+    times[0, 0, 0] = size
+    times[~reached.reshape(20, 20, 20)] = np.inf
+    return times
+
+# input: offsets table, offset weights
+# output: dictionary of the probability of each line (and the clover
+#         pattern) paying each symbol after a spin
+#
+# Evaluates compareline on every reachable state. Each is visited
+# equally often in the long run, so these are the fractions of spins
+# that pay over a long session; when the chain is periodic, the odds
+# of a given spin depend on its phase and differ from them.
+def payout_probabilities(offsetset=offsets, weights=offsetweights):
+    reached, level = reachable_states(*transition_matrix(offsetset, weights))
+    states = np.flatnonzero(reached)
+    probabilities = {line: {} for line in list(paylines) + ['clover']}
+    for state in states:
+        spin = reelwindow(np.unravel_index(state, (20, 20, 20)))
+        for line in paylines:
+            x = paylines[line]
+            symbol = compareline(spin[x[0]], spin[x[1]], spin[x[2]])
+            if symbol:
+                probabilities[line][symbol] = probabilities[line].get(symbol, 0) + 1
+        if compareclover(spin):
+            probabilities['clover'][7] = probabilities['clover'].get(7, 0) + 1
+    for line in probabilities:
+        for symbol in probabilities[line]:
+            probabilities[line][symbol] = probabilities[line][symbol] / len(states)
+    return probabilities
+
+# input: offsets table, offset weights
+# output: dictionary summarizing the chain
+#
+# Runs every part of the exact analysis for one offsets set.
+def analyze(offsetset=offsets, weights=offsetweights):
+    nextstates, probs = transition_matrix(offsetset, weights)
+    reached, level = reachable_states(nextstates, probs)
+    numreached = int(reached.sum())
+    times = hitting_times(offsetset, weights)
+    hits = times.ravel()[reached]
+    hits = hits[1:] if numreached > 1 else hits # exclude the return time to (0,0,0)
+
+    # Matthews' bounds on the expected cover time
+    harmonic = sum(1 / n for n in range(1, numreached))
+    return {
+        'reachable': numreached,
+        'period': periodicity(nextstates, probs, level),
+        'stationary': 1 / numreached,
+        'mean_hitting_time': float(hits.mean()),
+        'max_hitting_time': float(hits.max()),
+        'cover_time_bounds': (float(hits.min() * harmonic), float(hits.max() * harmonic)),
+        'payouts': payout_probabilities(offsetset, weights)
+    }
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--offsets', type=int, nargs='+', help='offset triples, flattened (e.g. 5 7 12 5 7 10 ...)')
+    parser.add_argument('--weights', type=float, nargs='+', help='probability of each offset triple')
+    args = parser.parse_args()
+    offsetset = [args.offsets[n:n + 3] for n in range(0, len(args.offsets), 3)] if args.offsets else offsets
+    weights = args.weights if args.weights else offsetweights
+
+    start = time.perf_counter()
+    report = analyze(offsetset, weights)
+    print('REACHABLE STATES: ' + str(report['reachable']) + ', PERIOD: ' + str(report['period']))
+    print('LONG-RUN FRACTION OF SPINS ON EACH STATE: ' + str(report['stationary']))
+    print('MEAN/MAX HITTING TIME: ' + str(round(report['mean_hitting_time'], 1)) + '/' + str(round(report['max_hitting_time'], 1)))
+    print('COVER TIME BETWEEN ' + str(round(report['cover_time_bounds'][0])) + ' AND ' + str(round(report['cover_time_bounds'][1])) + ' SPINS')
+    for line in report['payouts']:
+        print(line.upper() + ': ' + str({symbol: round(p, 5) for symbol, p in sorted(report['payouts'][line].items())}))
+    print('TOOK ' + str(round(time.perf_counter() - start, 3)) + 'S')
@@ -0,0 +1,120 @@
+# This class contains a vectorized version of the collision analysis
+# in runanalyses.test_combinations. Instead of following one session
+# at a time, thousands of independent sessions advance together as
+# rows of NumPy arrays. Each session keeps a flat table of the spin at
+# which every one of the 8000 states was first reached, from which
+# both the spins needed to reach every state and the states reached
+# after any number of spins can be read off. The result is the full
+# distribution of both rather than a single number.
+#
+# Sessions are split into fixed-size chunks that each get their own
+# child of one seed, so a run is reproducible for a given seed no
+# matter how many worker processes share the chunks.
+
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from runanalyses import offsets, offsetweights
+
+# sessions simulated together in one chunk; bounds the memory of a
+# chunk to about chunk_size * 32KB
+chunk_size = 1000
+
+# spins drawn and applied at once within a chunk
+block_size = 1024
+
+# first-visit value of a state that has not been reached
+never = np.iinfo(np.int32).max
+
+# input: number of sessions, number of spins, seed sequence, offsets table,
+#        offset weights, spin counts to record coverage at
+# output: spins to full coverage per session (-1 if never reached) and
+#         states reached per session at each checkpoint
+#
+# Simulates one chunk of sessions. Every session starts at state
+# (0,0,0) like test_combinations, but that state is only counted once
+# a spin lands on it. Spins are drawn a block at a time: the reel
+# positions of a whole block come from one cumulative sum of offsets,
+# and np.minimum.at keeps the earliest spin that reached each state.
+# The loop stops early once every session in the chunk has reached
+# all states.
+def simulate_chunk(numsessions, numspins, seedseq, offsetset=offsets, weights=offsetweights, checkpoints=()):
+    rng = np.random.default_rng(seedseq)
+    steps = np.array(offsetset, dtype=np.int64) % 20
+
+    base = (np.arange(numsessions, dtype=np.int64) * 8000)[np.newaxis, :]
+    indices = np.zeros((numsessions, 3), dtype=np.int64)
+    firstvisit = np.full((numsessions, 8000), never, dtype=np.int32)
+
+    for start in range(0, numspins, block_size):
+        count = min(block_size, numspins - start)
+        choice = rng.choice(len(steps), size=(count, numsessions), p=weights)
+        positions = (indices + np.cumsum(steps[choice], axis=0)) % 20
+        indices = positions[-1]
+
+        state = 400 * positions[:, :, 0] + 20 * positions[:, :, 1] + positions[:, :, 2]
+        spins = np.broadcast_to(np.arange(start + 1, start + count + 1, dtype=np.int32)[:, np.newaxis], state.shape)
+        np.minimum.at(firstvisit.reshape(-1), (base + state).ravel(), spins.ravel())
+
+        if (firstvisit < never).all():
+            break
+
+    coverspins = firstvisit.max(axis=1).astype(np.int64)
+    coverspins[coverspins == never] = -1
+    coverage = np.zeros((numsessions, len(checkpoints)), dtype=np.int64)
+    for column, k in enumerate(checkpoints):
+        coverage[:, column] = (firstvisit <= k).sum(axis=1)
+    return coverspins, coverage
+
+# input: number of sessions, spins per session, seed, worker processes,
+#        offsets table, offset weights, spin counts to record coverage at
+# output: dictionary with the array of spins to full coverage ('cover',
+#         -1 where a session never reached every state) and the array of
+#         states reached at each checkpoint ('coverage', one column per
+#         checkpoint)
+#
+# Splits the sessions into chunks and simulates them, in parallel
+# when more than one worker is given.
+def simulate_sessions(numsessions, numspins, seed=None, workers=1, offsetset=offsets,
+                      weights=offsetweights, checkpoints=()):
+    checkpoints = sorted(k for k in checkpoints if 0 < k <= numspins)
+    sizes = [min(chunk_size, numsessions - start) for start in range(0, numsessions, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(size, numspins, seedseq, offsetset, weights, checkpoints) for size, seedseq in zip(sizes, seeds)]
+
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(simulate_chunk, *zip(*args)))
+    else:
+        results = [simulate_chunk(*arg) for arg in args]
+
+    return {'checkpoints': checkpoints,
+            'cover': np.concatenate([result[0] for result in results]),
+            'coverage': np.concatenate([result[1] for result in results])}
+
+# input: result of simulate_sessions
+# output: N/A
+#
+# Prints percentiles of the spins to full coverage and the mean
+# coverage at each checkpoint.
+def print_summary(result):
+    cover = result['cover']
+    reached = cover[cover >= 0]
+    print(str(len(reached)) + ' OF ' + str(len(cover)) + ' SESSIONS REACHED ALL COMBINATIONS.')
+    if len(reached):
+        print('SPINS TO ALL COMBINATIONS: MEAN ' + str(round(reached.mean(), 1)) +
+              ', P5/P50/P95 ' + str(np.percentile(reached, [5, 50, 95]).round(1).tolist()))
+    for column, k in enumerate(result['checkpoints']):
+        print('AFTER ' + str(k) + ' SPINS: ' + str(round(result['coverage'][:, column].mean(), 1)) + ' COMBINATIONS ON AVERAGE')
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--spins', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--checkpoints', type=int, nargs='*', default=[1000, 8000, 50000])
+    args = parser.parse_args()
+    print_summary(simulate_sessions(args.sessions, args.spins, args.seed, args.workers,
+                                    checkpoints=args.checkpoints))
@@ -0,0 +1,254 @@
+# This class contains the search for the offsets table and offset
+# weights of runanalyses.py, which were chosen by hand. Candidate
+# offsets sets are built from every triple of a few offset values mod
+# 20 (increasing, like the current triples), and each set is tried with
+# every distinct assignment of the weights to its triples. Every
+# candidate is scored exactly with markov.py instead of being simulated:
+#   -coverage: the states reachable from (0,0,0)
+#   -cover time: Matthews' bounds from the hitting times
+#   -house edge and payout variance per spin at each bet size against a
+#    paytable, over the stationary distribution, which is uniform over
+#    the reachable states
+# When a set does not reach every state, the states split into cosets
+# of the reachable ones and the edge depends on which coset the
+# machine starts in, so the range of the edge over the cosets is
+# reported too.
+#
+# The reachable states, cosets and payouts depend only on the set and
+# the paytable, so they are worked out once per set, and only the
+# hitting times once per weight assignment. Sets are scored in chunks
+# across a process pool. Every score is memoized in memory and in a
+# JSON file keyed by the offsets, weights and paytable (and discarded
+# when the reels change), so a repeated or widened search only scores
+# the candidates it has not seen before.
+
+import argparse
+import itertools
+import json
+import numpy as np
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+import markov
+import paysearch
+import runanalyses as ra
+
+# scores already computed by candidate key, in memory and on disk;
+# the file also records the reels they were computed for
+scores = {}
+cache_path = 'offset_scores.json'
+
+# offset sets scored per pool task
+chunk_size = 64
+
+# per-state payouts already built, keyed by the reels and paytable
+statepayouts = {}
+
+# input: offset values, number of triples per set
+# output: list of every offsets set of that many increasing triples
+def candidate_sets(values, size):
+    triples = [list(triple) for triple in itertools.combinations(sorted(set(value % 20 for value in values)), 3)]
+    return [list(offsetset) for offsetset in itertools.combinations(triples, size)]
+
+# input: list of weights
+# output: list of every distinct ordering of the weights
+def weight_orders(weights):
+    return [list(order) for order in sorted(set(itertools.permutations(weights)))]
+
+# input: offsets set, weights, dictionary of payout winning values
+# output: string identifying the candidate's score
+#
+# The triples are sorted with their weights, so the same table listed
+# in another order (like the one in runanalyses.py) has the same key.
+def candidate_key(offsetset, weights, winnings):
+    pairs = sorted([[int(value) for value in triple], float(weight)] for triple, weight in zip(offsetset, weights))
+    return json.dumps([pairs, [winnings.get(str(label), 0) for label in range(1, 8)]])
+
+# input: dictionary of payout winning values (missing labels pay 0)
+# output: 8000x3 array of the winnings of landing on each state
+#         w.r.t. betsize, the state (i, j, k) numbered 400i + 20j + k
+def state_payouts(winnings):
+    key = str(ra.reels) + str(sorted(winnings.items()))
+    if key not in statepayouts:
+        reels = np.array(ra.reels)
+        indices = np.unravel_index(np.arange(8000), (20, 20, 20))
+        spins = np.stack([reels[reel][(indices[reel] + row) % 20] for row in range(3) for reel in range(3)], axis=1)
+        statepayouts.clear()
+        statepayouts[key] = ra.spin_payouts(spins, winnings)
+    return statepayouts[key]
+
+# input: boolean array of the states reachable from (0,0,0)
+# output: array numbering the coset of every state, (0,0,0)'s being 0
+def cosets(reached):
+    members = np.unravel_index(np.flatnonzero(reached), (20, 20, 20))
+    coset = np.full(8000, -1)
+    count = 0
+    for state in range(8000):
+        if coset[state] >= 0:
+            continue
+        shift = np.unravel_index(state, (20, 20, 20))
+        coset[400 * ((members[0] + shift[0]) % 20) + 20 * ((members[1] + shift[1]) % 20) +
+              (members[2] + shift[2]) % 20] = count
+        count = count + 1
+    return coset
+
+# input: list of offsets sets, list of weight orders per set,
+#        dictionary of payout winning values
+# output: list of (candidate key, score) for every set and weight order
+#
+# Scores one chunk of candidates; this is the pool task.
+@instrument.stage('score_sets')
+def score_sets(offsetsets, weightorders, winnings):
+    payouts = state_payouts(winnings)
+    results = []
+    for offsetset, orders in zip(offsetsets, weightorders):
+        nextstates = markov.next_states(offsetset)
+        reached, level = markov.reachable_states(nextstates, np.ones(len(offsetset)))
+        numreached = int(reached.sum())
+        period = markov.periodicity(nextstates, np.ones(len(offsetset)), level)
+
+        # the stationary payouts of the coset of (0,0,0) and the mean
+        # payouts of every other coset
+        coset = cosets(reached)
+        means = np.stack([np.bincount(coset, weights=payouts[:, bet]) / numreached for bet in range(3)], axis=1)
+        cost = np.arange(1, 4)
+        edges = 1 - means[0] / cost
+        overall = 1 - means.sum(axis=1) / cost.sum()
+        variance = payouts[reached].var(axis=0)
+
+        harmonic = sum(1 / n for n in range(1, numreached))
+        for weights in orders:
+            hits = markov.hitting_times(offsetset, weights, reached).ravel()[reached]
+            hits = hits[1:] if numreached > 1 else hits # exclude the return time to (0,0,0)
+            if instrument.enabled:
+                instrument.add(rows=1)
+            results.append((candidate_key(offsetset, weights, winnings), {
+                'offsets': offsetset,
+                'weights': list(weights),
+                'reachable': numreached,
+                'coverage': numreached / 8000,
+                'period': period,
+                'mean_hitting_time': float(hits.mean()),
+                'cover_time_bounds': [float(hits.min() * harmonic), float(hits.max() * harmonic)],
+                'edges': edges.round(6).tolist(),
+                'edge': round(float(overall[0]), 6),
+                'edge_range': [round(float(overall.min()), 6), round(float(overall.max()), 6)],
+                'variance': variance.round(6).tolist()
+            }))
+    return results
+
+# input: cache file
+# output: N/A
+#
+# Adds the scores cached on disk to the ones in memory, unless they
+# were computed for other reels.
+def load_cache(path=None):
+    path = cache_path if path is None else path
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get('reels') == ra.reels:
+            scores.update(cached['scores'])
+
+# input: cache file
+# output: N/A
+def save_cache(path=None):
+    path = cache_path if path is None else path
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump({'reels': ra.reels, 'scores': scores}, f)
+    os.replace(temp, path)
+
+# input: score of a candidate, threshold bands (profit per 1000 spins)
+# output: whether the candidate's edge at every bet size falls in the bands
+#
+# The bands are profits at bets of 1, 2 and 3 diamonds, so each is
+# scaled to a fraction of what 1000 spins at that bet take in, the
+# same way paysearch.house_edges turns profits into edges.
+def in_bands(score, bands=paysearch.thresholds):
+    return all(band[0] / (1000 * bet) <= edge <= band[1] / (1000 * bet)
+               for bet, edge, band in zip(range(1, 4), score['edges'], bands))
+
+# input: offset values, weights, dictionary of payout winning values,
+#        triples per set, worker processes, cache file
+# output: list of the scores of every candidate, best first
+#
+# Scores the candidates missing from the cache, in parallel when more
+# than one worker is given, and saves the new ones. Candidates are
+# ranked by coverage, then by whether their edges fall within the
+# threshold bands of paysearch.py, then by the upper bound on their
+# cover time and finally by the variance of the payouts at 3 diamonds.
+@instrument.stage('search_offsets')
+def search_offsets(values, weights, winnings, size=None, workers=1, path=None):
+    size = len(weights) if size is None else size
+    load_cache(path)
+    orders = weight_orders(weights[:size])
+    offsetsets = candidate_sets(values, size)
+
+    missing = []
+    for offsetset in offsetsets:
+        needed = [order for order in orders if candidate_key(offsetset, order, winnings) not in scores]
+        if needed:
+            missing.append((offsetset, needed))
+    chunks = [missing[n:n + chunk_size] for n in range(0, len(missing), chunk_size)]
+    args = [([item[0] for item in chunk], [item[1] for item in chunk], winnings) for chunk in chunks]
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(instrument.pool_map(pool, score_sets, *zip(*args)))
+    else:
+        results = [score_sets(*arg) for arg in args]
+    for result in results:
+        scores.update(result)
+    if missing:
+        save_cache(path)
+
+    ranked = [scores[candidate_key(offsetset, order, winnings)] for offsetset in offsetsets for order in orders]
+    ranked.sort(key=lambda score: (-score['reachable'], not in_bands(score), score['cover_time_bounds'][1],
+                                   score['variance'][2]))
+    return ranked
+
+# input: score of a candidate, its rank
+# output: N/A
+def print_score(score, rank):
+    print(str(rank).rjust(4) + '. OFFSETS ' + str(score['offsets']) + ' WEIGHTS ' + str(score['weights']))
+    print('      REACHABLE ' + str(score['reachable']) + ' (PERIOD ' + str(score['period']) + '), COVER TIME ' +
+          str(round(score['cover_time_bounds'][0])) + '-' + str(round(score['cover_time_bounds'][1])) +
+          ' SPINS, MEAN HITTING TIME ' + str(round(score['mean_hitting_time'], 1)))
+    print('      EDGES ' + str([round(edge, 4) for edge in score['edges']]) + (' IN' if in_bands(score) else ' OUT OF') +
+          ' BANDS, OVERALL ' + str(round(score['edge'], 4)) + ' (' + str(round(score['edge_range'][0], 4)) + ' TO ' +
+          str(round(score['edge_range'][1], 4)) + ' BY START), VARIANCE ' +
+          str([round(variance, 2) for variance in score['variance']]))
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--values', type=int, nargs='+', default=sorted(set(sum(ra.offsets, []))),
+                        help='offset values the triples are made from')
+    parser.add_argument('--weights', type=float, nargs='+', default=ra.offsetweights,
+                        help='weights assigned to the triples of each set, in every order')
+    parser.add_argument('--winnings', type=int, nargs=7, default=[2, 8, 20, 0, 64, 0, 0],
+                        help='payout of each of the seven symbols')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--top', type=int, default=10, help='number of candidates to print')
+    parser.add_argument('--output', metavar='PATH', help='write the full ranking as JSON')
+    instrument.add_argument(parser)
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrument.enable()
+
+    winnings = {str(label + 1): args.winnings[label] for label in range(7)}
+    start = time.perf_counter()
+    ranked = search_offsets(args.values, args.weights, winnings, workers=args.workers)
+    print(str(len(ranked)) + ' CANDIDATES RANKED IN ' + str(round(time.perf_counter() - start, 3)) + 'S')
+    # the cache may know the current offsets even when this search left them out
+    current = scores.get(candidate_key(ra.offsets, ra.offsetweights, winnings))
+    if current is not None and current in ranked:
+        print('CURRENT OFFSETS RANK ' + str(ranked.index(current) + 1))
+    for rank, score in enumerate(ranked[:args.top]):
+        print_score(score, rank + 1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(ranked, f, indent=1)
+    instrument.finish(args.profile)
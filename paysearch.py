@@ -0,0 +1,186 @@
+# This class contains the paytable search behind optimize_profit,
+# generalized to any candidate payouts for all seven symbols. Each
+# paytable's profit to the machine is a dot product with the payout
+# counts from runanalyses.payout_counts, so whole blocks of the
+# Cartesian product are evaluated as one matrix operation.
+#
+# The symbols are split in two: the outer ones are enumerated a chunk
+# at a time, and every payout combination of the inner ones is added
+# to each outer prefix at once. A prefix is pruned before that step if
+# even the smallest or largest inner payouts cannot bring it inside the
+# threshold bands, since profit only falls as a payout rises.
+
+import argparse
+import instrument
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# acceptable profit to the machine at each bet size, per 1000 spins
+thresholds = [[200,500],[500,900],[800,1300]]
+
+# upper bound on the entries of one (prefixes x inner combinations x 3)
+# block of profits
+block_limit = 2 ** 22
+
+# input: list of candidate value lists
+# output: array with one row per combination, the first list varying slowest
+def cartesian(candidates):
+    grids = np.meshgrid(*[np.asarray(values, dtype=np.int64) for values in candidates], indexing='ij')
+    return np.stack([grid.ravel() for grid in grids], axis=1)
+
+# input: number of spins, payout counts, candidate values per symbol,
+#        threshold bands, first and last outer prefix to search
+# output: array of paytables (one row of 7 payouts each) within the
+#         bands, and their profits at each bet size
+#
+# Searches one range of outer prefixes. The bands are scaled from
+# per-1000-spin values to the number of spins in the table.
+@instrument.stage('search_range')
+def search_range(numspins, counts, candidates, bands, start, stop, split):
+    counts = np.asarray(counts, dtype=np.int64)
+    low = np.array([band[0] for band in bands]) * numspins / 1000
+    high = np.array([band[1] for band in bands]) * numspins / 1000
+    paid = numspins * np.arange(1, 4)
+
+    inner = cartesian(candidates[split:])
+    innerpayout = inner @ counts[:, split:].T
+    innermin = innerpayout.min(axis=0)
+    innermax = innerpayout.max(axis=0)
+
+    radix = [len(values) for values in candidates[:split]]
+    outervalues = [np.asarray(values, dtype=np.int64) for values in candidates[:split]]
+    step = max(1, block_limit // (3 * len(inner)))
+
+    tables = []
+    profits = []
+    for first in range(start, stop, step):
+        digits = np.unravel_index(np.arange(first, min(first + step, stop)), radix)
+        outer = np.stack([outervalues[n][digits[n]] for n in range(split)], axis=1)
+        prefix = paid - outer @ counts[:, :split].T
+        if instrument.enabled:
+            instrument.add(rows=len(outer) * len(inner))
+
+        # prune prefixes that no inner combination can bring within the bands
+        keep = ((prefix - innermin >= low) & (prefix - innermax <= high)).all(axis=1)
+        outer = outer[keep]
+        prefix = prefix[keep]
+        if not len(outer):
+            continue
+
+        profit = prefix[:, np.newaxis, :] - innerpayout[np.newaxis, :, :]
+        inrange = ((profit >= low) & (profit <= high)).all(axis=2)
+        rows, columns = np.nonzero(inrange)
+        tables.append(np.concatenate([outer[rows], inner[columns]], axis=1))
+        profits.append(profit[rows, columns])
+
+    if not tables:
+        return np.zeros((0, len(candidates)), dtype=np.int64), np.zeros((0, 3))
+    return np.concatenate(tables), np.concatenate(profits)
+
+# input: number of spins, payout counts, candidate values for each of the
+#        seven symbols, threshold bands, worker processes
+# output: array of paytables within the bands and their profits at each
+#         bet size, in the order of the Cartesian product
+#
+# Splits the outer prefixes into contiguous ranges, one per task, and
+# searches them in parallel when more than one worker is given.
+@instrument.stage('valid_paytables')
+def valid_paytables(numspins, counts, candidates, bands=thresholds, workers=1):
+    # enumerate enough symbols on the outside to give every worker work,
+    # while keeping the inner combinations at a few thousand at most
+    split = len(candidates)
+    innersize = 1
+    while split > 1 and innersize * len(candidates[split - 1]) <= 4096:
+        split = split - 1
+        innersize = innersize * len(candidates[split])
+    numprefixes = int(np.prod([len(values) for values in candidates[:split]]))
+
+    tasks = max(1, min(numprefixes, 4 * workers))
+    bounds = np.linspace(0, numprefixes, tasks + 1).astype(int)
+    args = [(numspins, counts, candidates, bands, bounds[n], bounds[n + 1], split) for n in range(tasks)]
+    if workers > 1 and tasks > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(instrument.pool_map(pool, search_range, *zip(*args)))
+    else:
+        results = [search_range(*arg) for arg in args]
+    return np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results])
+
+# input: number of spins, array of profits at each bet size
+# output: array of house edges at each bet size
+def house_edges(numspins, profits):
+    return np.asarray(profits) / (numspins * np.arange(1, 4))
+
+# input: array of house edges, one row per paytable
+# output: indices of the Pareto-optimal rows
+#
+# A paytable is dominated when another one has a house edge no higher
+# at every bet size and lower at one of them, i.e. it pays the player
+# at least as much everywhere. The remaining row with the lowest summed
+# edges can never be dominated, so it joins the front and every row it
+# dominates is dropped in one vectorized step; this repeats once per
+# row on the front rather than once per paytable.
+@instrument.stage('pareto_front')
+def pareto_front(edges):
+    remaining = np.argsort(edges.sum(axis=1), kind='stable')
+    front = []
+    while len(remaining):
+        best = edges[remaining[0]]
+        front.append(remaining[0])
+        dominated = (edges[remaining] >= best).all(axis=1) & (edges[remaining] > best).any(axis=1)
+        dominated[0] = True
+        remaining = remaining[~dominated]
+    return np.array(front, dtype=np.int64)
+
+# input: number of spins, payout counts, candidate values per symbol,
+#        threshold bands, worker processes
+# output: list of dictionaries describing the Pareto-optimal paytables,
+#         lowest overall house edge first
+#
+# Full search: every paytable in the bands, reduced to the ones that
+# are not dominated. The overall edge weighs each bet size by the
+# diamonds it takes in.
+@instrument.stage('search_paytables')
+def search_paytables(numspins, counts, candidates, bands=thresholds, workers=1):
+    tables, profits = valid_paytables(numspins, counts, candidates, bands, workers)
+    if not len(tables):
+        return []
+    edges = house_edges(numspins, profits)
+    overall = profits.sum(axis=1) / (numspins * 6)
+
+    # paytables with the same profits share their place on the front
+    unique, inverse = np.unique(profits, axis=0, return_inverse=True)
+    front = np.flatnonzero(np.isin(inverse.ravel(), pareto_front(house_edges(numspins, unique))))
+    front = front[np.argsort(overall[front], kind='stable')]
+    return [{'winnings': {str(label + 1): int(tables[index][label]) for label in range(7)},
+             'prizes': profits[index].astype(int).tolist(),
+             'edges': edges[index].round(4).tolist(),
+             'edge': round(float(overall[index]), 4)} for index in front]
+
+# main driver
+if __name__ == '__main__':
+    import database
+    import time
+    from runanalyses import payout_counts
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sqlite', metavar='PATH', help='read spins from a local SQLite file instead of MySQL')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--top', type=int, default=10, help='number of paytables to print')
+    names = ['iron', 'rawgold', 'gold', 'emerald', 'diamond', 'netherite', 'clover']
+    defaults = [[2,4,8],[4,8,12],[12,16,20],[0],[32,48,64],[0],[0]]
+    for name, values in zip(names, defaults):
+        parser.add_argument('--' + name, type=int, nargs='+', default=values, help='candidate payouts')
+    instrument.add_argument(parser)
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrument.enable()
+
+    numspins, counts = payout_counts(database.get_connection(path=args.sqlite).cursor())
+    candidates = [getattr(args, name) for name in names]
+    start = time.perf_counter()
+    results = search_paytables(numspins, counts, candidates, workers=args.workers)
+    print(str(int(np.prod([len(values) for values in candidates]))) + ' PAYTABLES SEARCHED IN ' +
+          str(round(time.perf_counter() - start, 3)) + 'S, ' + str(len(results)) + ' PARETO-OPTIMAL')
+    for result in results[:args.top]:
+        print(result)
+    instrument.finish(args.profile)
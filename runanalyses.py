@@ -21,39 +21,69 @@
 #   -expose the vulnerabilities of the machine by developing an algorithm
 #    that bets dynamically and increases the profit to the player
 
-import mysql.connector
+import argparse
+import database
+import hashlib
+import instrument
+import json
 import numpy as np
+import paysearch
 import random as r
 
-# mysql connection
-mydb = mysql.connector.connect(
-    host='localhost',
-    user='<user>',
-    password='<password>'
-)
-
 # all possible state offsets per spin. I took advantage of
 # prime offset behavior to theoretically minimize collisions.
 offsets = [[5,7,12],[5,7,10],[5,12,13],[7,11,13]]
 
-# input: number of spins the method will simulate
+# the theoretical probabilities of each offset being applied.
+# this array lines up with the offsets array above.
+offsetweights = [0.125, 0.125, 0.25, 0.5]
+
+# input: number of spins the method will simulate, Nx9 array
+#        of recorded spins to replay instead (optional)
 # output: number of spins to achieve all states OR
 #         number of states achieved in all spins
 #
 # Simulates the slot machine I made in minecraft by
-# representing each state in a 3d array and checking
-# if every state has been reached after each spin. The
+# marking each state reached in a flat bitmap of all
+# 8000 states, keeping a running count of the states
+# visited so the termination check is constant time. The
 # console then displays relevant information regarding
-# collisions. 
-def test_combinations(numspins):
+# collisions. See montecarlo.py to simulate many sessions
+# at once. Recorded spins are located on the reels with
+# locate_reels; spins that cannot be located, or whose windows
+# fit more than one state, are skipped and counted separately.
+@instrument.stage('test_combinations')
+def test_combinations(numspins, spins=None):
     # the starting indices can be arbitrary since the randomness
     # of a player's session is unaffected by previous states
     indices = [0,0,0]
+    if spins is not None:
+        numspins = min(numspins, len(spins))
 
-    # each reel is 20 blocks long for a possible 20^3 = 8000 states
-    states = [[[0 for i in range(20)] for j in range(20)] for k in range(20)]
+    # each reel is 20 blocks long for a possible 20^3 = 8000 states,
+    # state (i, j, k) lives at index 400i + 20j + k
+    states = bytearray(8000)
+    visited = 0
+    skipped = {'unrecognised': 0, 'ambiguous': 0}
 
     for n in range(numspins):
+        if spins is not None:
+            location = locate_reels([int(block) for block in spins[n]])
+            if location['confidence'] < 1:
+                kind = 'unrecognised' if location['unrecognised'] else 'ambiguous'
+                skipped[kind] = skipped[kind] + 1
+                continue
+            candidates = location['positions']
+            state = 400 * candidates[0][0] + 20 * candidates[1][0] + candidates[2][0]
+            if not states[state]:
+                states[state] = 1
+                visited = visited + 1
+            if visited == 8000:
+                print("ALL COMBINATIONS REACHED. TOOK " + str(n) + " SPINS.")
+                print(skipped_message(skipped))
+                return n
+            continue
+
         randval = r.random()
         offsetindex = -1
         if randval > 0.5: # 7-11-13
@@ -66,71 +96,196 @@ def test_combinations(numspins):
             offsetindex = 1
         for i in range(3):
             indices[i] = (indices[i] + offsets[offsetindex][i]) % 20
-        states[indices[0]][indices[1]][indices[2]] = 1
+        state = 400 * indices[0] + 20 * indices[1] + indices[2]
+        if not states[state]:
+            states[state] = 1
+            visited = visited + 1
 
         # check for termination
-        done = 0
-        for i in range(20):
-            if done:
-                break
-            for j in range(20):
-                if done:
-                    break
-                for k in range(20):
-                    if not states[i][j][k]:
-                        done = 1
-                        break
-        if not done: # all combinations have been reached
+        if visited == 8000: # all combinations have been reached
             print("ALL COMBINATIONS REACHED. TOOK " + str(n) + " SPINS.")
             return n
 
     # all spins exhausted without completion
-    combinationsfound = 0
-    # calculate total number of states achieved
-    for i in states:
-        for j in i:
-            for k in j:
-                if k:
-                    combinationsfound = combinationsfound + 1
-    print(str(combinationsfound) + " COMBINATIONS ACHIEVED IN " + str(numspins) + " SPINS.")
+    print(str(visited) + " COMBINATIONS ACHIEVED IN " + str(numspins) + " SPINS.")
+    if spins is not None:
+        print(skipped_message(skipped))
     return numspins
 
-# input: mysql cursor, # of diamonds to bet
+# input: dictionary of the recorded spins skipped by test_combinations
+# output: string reporting them
+def skipped_message(skipped):
+    return ("SKIPPED " + str(skipped['unrecognised']) + " UNRECOGNISED AND " + str(skipped['ambiguous']) +
+            " AMBIGUOUS SPINS.")
+
+# input: N/A
+# output: one SELECT counting every payout in the spins table
+#
+# The derived table works out, in a single pass over the spins, the
+# symbol each line pays (NULL when it does not pay) and whether a
+# clover pattern is present, using the rules in line_rule and
+# clover_rule. The outer query sums them per line and symbol, so the
+# server sends back one row of line_counts instead of every winning spin.
+def payline_query():
+    b = ['b' + str(n + 1) for n in range(9)]
+    columns = []
+    sums = []
+    for line in paylines:
+        x = [b[n] for n in paylines[line]]
+        columns.append('CASE WHEN ' + line_rule(x) + ' THEN CASE WHEN ' + x[0] + ' <> 0 THEN ' + x[0] +
+                       ' WHEN ' + x[1] + ' <> 0 THEN ' + x[1] + ' ELSE ' + x[2] + ' END END AS ' + line)
+        sums.append('COUNT(' + line + ')')
+        sums.extend('SUM(' + line + ' = ' + str(label) + ')' for label in range(1, 7))
+    columns.append('CASE WHEN ' + clover_rule(b) + ' THEN 7 END AS clover')
+    sums.append('COUNT(clover)')
+    return 'SELECT ' + ', '.join(sums) + ' FROM (SELECT ' + ', '.join(columns) + ' FROM spins) AS payouts'
+
+# input: mysql cursor
+# output: dictionary of line_counts for every line and the clover pattern
+#
+# A line of three amethysts counts as a win of its line but of no symbol.
+@instrument.stage('line_counts')
+def line_counts(dbcursor):
+    database.use_database(dbcursor)
+    dbcursor.execute(payline_query())
+    row = [int(value or 0) for value in dbcursor.fetchone()]
+    if instrument.enabled:
+        instrument.add(rows=1, queries=1)
+    counts = {line: row[7 * n:7 * n + 7] for n, line in enumerate(paylines)}
+    counts['clover'] = row[-1:]
+    return counts
+
+# input: Nx9 array of spins
+# output: the same dictionary as line_counts, made with comparelines
+@instrument.stage('array_line_counts')
+def array_line_counts(spins):
+    spins = np.asarray(spins).astype(np.int64)
+    counts = {}
+    for line in paylines:
+        x = spins[:, paylines[line]]
+        won = linespay(x[:, 0], x[:, 1], x[:, 2])
+        symbol = comparelines(x[:, 0], x[:, 1], x[:, 2])
+        counts[line] = [int(won.sum())] + [int((symbol == label).sum()) for label in range(1, 7)]
+    counts['clover'] = [int((compareclovers(spins) != 0).sum())]
+    return counts
+
+# input: mysql cursor, # of diamonds to bet, Nx9 array of spins to
+#        use instead of the database (optional, e.g. from spinstore)
 # output: dictionary of payout frequencies for all labels and lines w.r.t. betsize
 #
-# Collects frequency data from the mysql server by filtering each payout through a set
-# of sql SELECT statements and incrementing each payout occurence accordingly.
-def find_frequencies(dbcursor, betsize):
-    dbcursor.execute('USE slots_data;')
+# Collects frequency data from the mysql server with the single
+# aggregate query of line_counts and adds up the lines and clover
+# pattern that pay at betsize.
+@instrument.stage('find_frequencies')
+def find_frequencies(dbcursor, betsize, spins=None):
+    counts = line_counts(dbcursor) if spins is None else array_line_counts(spins)
+    return bet_frequencies(counts, betsize)
+
+# input: dictionary from line_counts, # of diamonds to bet
+# output: dictionary of payout frequencies for all labels and lines w.r.t. betsize
+def bet_frequencies(counts, betsize):
     values = {'1':0, '2':0, '3':0, '4':0, '5':0, '6':0, '7':0, 'mid':0, 'top':0, 'bot':0, 'di1':0, 'di2':0}
-    sqlfiles = ['clover.txt', 'mid.txt', 'top.txt', 'bot.txt', 'di1.txt', 'di2.txt']
-    for payout in range(6):
-        # terminate if not all payouts apply to spin of betsize
-        if (betsize == 1 and payout > 1) or (betsize == 2 and payout > 3):
-            break
-        f = open('wins/' + sqlfiles[payout])
-        dbcursor.execute(f.read())
-        wins = dbcursor.fetchall()
-        if payout == 0: # clover payout
-            if betsize > 1:
-                values['7'] = len(wins)
+    for line in paylines:
+        if minbets[line] > betsize:
             continue
-        else:
-            key = sqlfiles[payout][0:3]
-            values[key] = len(wins) 
-        for spin in wins:
-            for block in spin:
-                if block != 0:
-                    values[str(block)] = values[str(block)] + 1
-                    break
+        values[line] = counts[line][0]
+        for label in range(1, 7):
+            values[str(label)] = values[str(label)] + counts[line][label]
+    if betsize >= minbets['clover']:
+        values['7'] = counts['clover'][0]
     return values
 
+# payout counts computed so far, keyed by the version of the spins
+# table they were computed from; also saved to cache_path so other
+# processes and later runs can reuse them
+payoutcache = {}
+cache_path = 'payout_counts.json'
+
+# version of the spins table checked in this session, keyed by its
+# connection and the number of batches this process has written
+tableversions = {}
+
+# input: mysql cursor
+# output: list identifying the current contents of the spins table
+#         and the payout rules
+#
+# One aggregate query over the spins table: any insert, delete or
+# relabelled block changes the row count or one of the checksums. The
+# query runs once per connection and again only after this process
+# writes spins through database.SpinWriter, so repeated calls cost a
+# dictionary lookup; spins written by another process while this one
+# runs are only seen by its next session.
+@instrument.stage('table_version')
+def table_version(dbcursor):
+    key = (getattr(dbcursor, 'connection', None), database.stats['writes'])
+    if key not in tableversions:
+        database.use_database(dbcursor)
+        dbcursor.execute('SELECT COUNT(*), MAX(s), SUM(b1 + b2 + b3 + b4 + b5 + b6 + b7 + b8 + b9), '
+                         'SUM(s * (b1 + 2*b2 + 3*b3 + 4*b4 + 5*b5 + 6*b6 + 7*b7 + 8*b8 + 9*b9)) FROM spins')
+        version = [int(value or 0) for value in dbcursor.fetchone()]
+        if instrument.enabled:
+            instrument.add(queries=1)
+        tableversions.clear()
+        tableversions[key] = version + [hashlib.sha1(payline_query().encode('utf-8')).hexdigest()]
+    return tableversions[key]
+
+# input: mysql cursor
+# output: (number of spins, 3x7 array of wins per bet size and label)
+#
+# Runs the line_counts query, once for all bet sizes, only when the spins
+# table has changed since the counts were last computed, checking
+# memory first and then the file at cache_path.
+@instrument.stage('payout_counts')
+def payout_counts(dbcursor):
+    version = table_version(dbcursor)
+    key = json.dumps(version)
+    if key not in payoutcache:
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+        if cached.get('version') == version:
+            counts = np.array(cached['counts'], dtype=np.int64)
+        else:
+            counts = frequency_counts(line_counts(dbcursor))
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': version, 'counts': counts.tolist()}, f)
+        payoutcache.clear()
+        payoutcache[key] = (version[0], counts)
+    return payoutcache[key]
+
+# input: dictionary from line_counts
+# output: 3x7 array of wins per bet size and label, as payout_counts
+def frequency_counts(counts):
+    table = np.zeros((3, 7), dtype=np.int64)
+    for bet in range(3):
+        values = bet_frequencies(counts, bet + 1)
+        for label in range(7):
+            table[bet][label] = values[str(label + 1)]
+    return table
+
+# input: Nx9 array of spins
+# output: 3x7 array of wins per bet size and label, as payout_counts
+def array_counts(spins):
+    return frequency_counts(array_line_counts(spins))
+
+# input: number of spins, payout counts, dictionary of payout winning values
+# output: profit over all bet sizes
+#
+# Profit to the machine for one paytable: what the player paid in
+# minus the dot product of the payout counts with the paytable.
+def evaluate_paytable(numspins, counts, winnings):
+    paytable = np.array([int(winnings[str(label + 1)]) for label in range(7)], dtype=np.int64)
+    return (numspins * np.arange(1, 4) - counts @ paytable).tolist()
+
 # input: mysql cursor, dictionary of payout winning values
 # output: profit over all bet sizes
 #
 # finds the profit of diamonds to the machine, assuming the player
 # does not bet dynamically. No dictionary passed prompts
 # interactive mode, where results are both printed and passed.
+@instrument.stage('run_simulator')
 def run_simulator(dbcursor, winnings = {}):
     interactive = 0
     if len(winnings) == 0: # prompt the user for payout values
@@ -150,46 +305,127 @@ def run_simulator(dbcursor, winnings = {}):
         winnings['6'] = input()
         print('CLOVER:')
         winnings['7'] = input()
-    prizes = [0,0,0]
-    for bet in range(3):
-        profit = 1000 * (bet + 1)
-        values = find_frequencies(dbcursor, bet + 1)
-        for label in range(7):
-            profit = profit - (int(winnings[str(label + 1)]) * values[str(label + 1)])
-        if interactive:
+    numspins, counts = payout_counts(dbcursor)
+    prizes = evaluate_paytable(numspins, counts, winnings)
+    if interactive:
+        for bet in range(3):
             print(str(bet + 1) + ' DIAMOND BET RESULTS:')
-            print('PROFIT: ' + str(profit))
+            print('PROFIT: ' + str(prizes[bet]))
             print()
-        prizes[bet] = profit
     return prizes
 
 # input: mysql cursor
 # output: list of payout values that fall within the
 # profit threshold
 #
-# iterate through all combinations in payouts and filter
-# profits to fit between the ranges defined in threshold.
+# search all combinations in payouts and filter profits to
+# fit between the ranges defined in threshold. See paysearch.py
+# for searching larger grids of payouts.
+@instrument.stage('optimize_profit')
 def optimize_profit(dbcursor):
 
     threshold = [[200,500],[500,900],[800,1300]]
-    payouts = [[2,4,8],[4,8,12],[12,16,20],[32,48,64]]
+    payouts = [[2,4,8],[4,8,12],[12,16,20],[0],[32,48,64],[0],[0]]
 
+    numspins, counts = payout_counts(dbcursor)
+    tables, prizes = paysearch.valid_paytables(numspins, counts, payouts, threshold)
     validentries = []
-    for ival in payouts[0]:
-        for rval in payouts[1]:
-            for gval in payouts[2]:
-                for dval in payouts[3]:
-                    winnings = {'1': ival, '2': rval, '3': gval, '4': 0, '5': dval, '6': 0, '7': 0}
-                    prizes = run_simulator(dbcursor, winnings)
-                    inrange = 1
-                    for bet in range(3):
-                        if prizes[bet] < threshold[bet][0] or prizes[bet] > threshold[bet][1]:
-                            inrange = 0
-                            break
-                    if inrange:
-                        validentries.append(winnings)
+    for table in tables:
+        validentries.append({str(label + 1): int(table[label]) for label in range(7)})
     return validentries
 
+# the payout rules, written once as data and checked by the functions
+# below and by the SQL of line_rule and clover_rule. A line pays when
+# its blocks that are not amethysts (wild) all hold the same symbol and
+# none of them is a clover. Each clause lists the pairs of blocks
+# (indexed within the line) that must be equal, the blocks that must be
+# amethysts and the blocks that must not be.
+lineclauses = [([(0, 1), (1, 2)], [], []),
+               ([(0, 1)], [2], []),
+               ([(1, 2)], [0], []),
+               ([(0, 2)], [1], []),
+               ([], [0, 1], [2]),
+               ([], [1, 2], [0]),
+               ([], [0, 2], [1])]
+
+# a clover pattern is a 2x2 square of clovers (blocks indexed from 0)
+# with the given symbols on the blocks beside it
+cloverpatterns = [([0, 1, 3, 4], {6: 3, 7: 3}),
+                  ([1, 2, 4, 5], {7: 2, 8: 2}),
+                  ([3, 4, 6, 7], {0: 1, 1: 1}),
+                  ([4, 5, 7, 8], {1: 4, 2: 1})]
+
+# input: three blocks of a line
+# output: true if the line pays
+def linepays(x1, x2, x3):
+    x = [x1, x2, x3]
+    if 7 in x:
+        return False
+    for equal, wild, other in lineclauses:
+        if (all(x[a] == x[b] for a, b in equal) and all(x[n] == 0 for n in wild) and
+                all(x[n] != 0 for n in other)):
+            return True
+    return False
+
+# input: three arrays of blocks of a line
+# output: boolean array, true where the line pays
+def linespay(x1, x2, x3):
+    x = [x1, x2, x3]
+    pays = False
+    for equal, wild, other in lineclauses:
+        clause = True
+        for a, b in equal:
+            clause = clause & (x[a] == x[b])
+        for n in wild:
+            clause = clause & (x[n] == 0)
+        for n in other:
+            clause = clause & (x[n] != 0)
+        pays = pays | clause
+    for block in x:
+        pays = pays & (block != 7)
+    return pays
+
+# input: all nine blocks of a spin (b1, ..., b9)
+# output: true if a clover pattern is present
+def cloverpays(b):
+    for square, sides in cloverpatterns:
+        if all(b[n] == 7 for n in square) and all(b[n] == sides[n] for n in sides):
+            return True
+    return False
+
+# input: list of nine arrays of blocks (b1, ..., b9)
+# output: boolean array, true where a clover pattern is present
+def cloverspay(b):
+    pays = False
+    for square, sides in cloverpatterns:
+        clause = True
+        for n in square:
+            clause = clause & (b[n] == 7)
+        for n in sorted(sides):
+            clause = clause & (b[n] == sides[n])
+        pays = pays | clause
+    return pays
+
+# input: SQL expressions of the three blocks of a line
+# output: SQL condition that is true when the line pays
+def line_rule(x):
+    clauses = []
+    for equal, wild, other in lineclauses:
+        terms = ([x[a] + ' = ' + x[b] for a, b in equal] + [x[n] + ' = 0' for n in wild] +
+                 [x[n] + ' <> 0' for n in other])
+        clauses.append('(' + ' AND '.join(terms) + ')')
+    noclover = [block + ' <> 7' for block in x]
+    return '(' + ' AND '.join(['(' + ' OR '.join(clauses) + ')'] + noclover) + ')'
+
+# input: SQL expressions of the nine blocks of a spin
+# output: SQL condition that is true when a clover pattern is present
+def clover_rule(b):
+    clauses = []
+    for square, sides in cloverpatterns:
+        terms = [b[n] + ' = 7' for n in square] + [b[n] + ' = ' + str(sides[n]) for n in sorted(sides)]
+        clauses.append('(' + ' AND '.join(terms) + ')')
+    return '(' + ' OR '.join(clauses) + ')'
+
 # input: three blocks from the spin to compare
 # output: the symbol of the payout present, else 0
 #
@@ -198,21 +434,35 @@ def optimize_profit(dbcursor):
 # for the adversary function since all future options need
 # to be checked for their weights.
 def compareline(x1, x2, x3):
-    symbol = 0
-    if (x1 == x2 and x2 == x3 or
-        x1 == x2 and x3 == 0 or
-        x2 == x3 and x1 == 0 or
-        x1 == x3 and x2 == 0 or
-        x1 == 0 and x2 == 0 and x3 != 0 or
-        x2 == 0 and x3 == 0 and x1 != 0 or
-        x1 == 0 and x3 == 0 and x2 != 0) and x1 != 7 and x2 != 7 and x3 != 7:
-        if x1 != 0:
-            symbol = x1
-        elif x2 != 0:
-            symbol = x2
-        elif x3 != 0:
-            symbol = x3
-    return symbol
+    if linepays(x1, x2, x3):
+        return x1 if x1 != 0 else x2 if x2 != 0 else x3
+    return 0
+
+# input: all nine blocks of a spin (b1, ..., b9)
+# output: 7 if one of the clover patterns is present, else 0
+def compareclover(spin):
+    return 7 if cloverpays(spin) else 0
+
+# input: three arrays of blocks to compare, elementwise
+# output: array of the symbol of the payout present, else 0
+#
+# The same comparisons as compareline, made on whole columns of
+# spins at once.
+def comparelines(x1, x2, x3):
+    x1, x2, x3 = np.asarray(x1), np.asarray(x2), np.asarray(x3)
+    symbol = np.where(x1 != 0, x1, np.where(x2 != 0, x2, x3))
+    return np.where(linespay(x1, x2, x3), symbol, 0)
+
+# input: Nx9 array of spins
+# output: array of 7 where a clover pattern is present, else 0
+def compareclovers(spins):
+    b = [np.asarray(spins)[..., n] for n in range(9)]
+    return np.where(cloverspay(b), 7, 0)
+
+# blocks (b1..b9, indexed from 0) that make up each payline, and
+# the smallest bet size that pays each line or the clover pattern
+paylines = {'mid': [3,4,5], 'top': [0,1,2], 'bot': [6,7,8], 'di1': [0,4,8], 'di2': [6,4,2]}
+minbets = {'mid': 1, 'top': 2, 'bot': 2, 'di1': 3, 'di2': 3, 'clover': 2}
 
 # this structure represents the order of symbols in
 # each reel, using the same labels in the sql server.
@@ -222,109 +472,180 @@ reels = [[4,1,2,3,0,1,1,3,2,4,5,1,1,2,1,7,7,3,6,2],
 [2,3,1,1,0,1,2,5,4,7,7,2,3,6,2,1,7,7,3,4],
 [2,4,1,3,1,0,2,6,3,1,4,1,7,7,2,1,3,2,5,1]]
 
-# input: current spin in the dataset
+# window indices already built, keyed by the reels they were built from
+windowindices = {}
+
+# input: N/A
+# output: list with one dictionary per reel, mapping each (top, mid,
+#         bottom) window of symbols to every index where it starts
+#
+# Indexes every window of three consecutive blocks on each reel,
+# wrapping around the end, so a reel is located by one lookup.
+def window_index():
+    key = str(reels)
+    if key not in windowindices:
+        index = [{} for reel in reels]
+        for reel in range(len(reels)):
+            for block in range(20):
+                window = tuple(reels[reel][(block + row) % 20] for row in range(3))
+                index[reel].setdefault(window, []).append(block)
+        windowindices.clear()
+        windowindices[key] = index
+    return windowindices[key]
+
+# input: array of the symbols paid (0 if none), array of winnings
+#        indexed by symbol
+# output: array of the winnings of each symbol
+#
+# Symbols outside 1..7 (an unlabelled -1 or a stored 255) pay 0.
+def symbol_winnings(symbols, paytable):
+    return paytable[np.where((symbols >= 1) & (symbols <= 7), symbols, 0)]
+
+# input: Nx9 array of spins, dictionary of payout winning values
+#        (missing labels pay 0)
+# output: Nx3 array of the winnings of each spin w.r.t. betsize
+#
+# Unlabelled blocks (-1) pay nothing; spins from a spin store should go
+# through spinstore.labels first.
+@instrument.stage('spin_payouts')
+def spin_payouts(spins, winnings):
+    spins = np.asarray(spins)
+    paytable = np.array([0] + [int(winnings.get(str(label), 0)) for label in range(1, 8)])
+    payouts = np.zeros((len(spins), 3), dtype=np.int64)
+    for line in paylines:
+        x = paylines[line]
+        symbol = comparelines(spins[:, x[0]], spins[:, x[1]], spins[:, x[2]])
+        payouts[:, minbets[line] - 1:] += symbol_winnings(symbol, paytable)[:, np.newaxis]
+    payouts[:, minbets['clover'] - 1:] += symbol_winnings(compareclovers(spins), paytable)[:, np.newaxis]
+    return payouts
+
+# input: all nine blocks of a spin (b1, ..., b9)
+# output: dictionary locating the spin on the reels:
+#           'positions'    - list with one list of candidate indices
+#                            of the top block per reel
+#           'weights'      - list with the probability of each of those
+#                            candidates per reel
+#           'confidence'   - probability that the most likely state
+#                            (i, j, k) is the machine's, 0 if unrecognised
+#           'unrecognised' - true if a reel's window appears nowhere on
+#                            it (usually a labelling error)
+#
+# A window that appears more than once on a reel is equally likely to
+# be at each index it appears at. An unrecognised reel has no
+# candidates.
+def locate_reels(spin):
+    index = window_index()
+    positions = [index[reel].get((spin[reel], spin[3 + reel], spin[6 + reel]), []) for reel in range(3)]
+    weights = [[1 / len(candidates) for position in candidates] for candidates in positions]
+    unrecognised = not all(positions)
+    confidence = 0 if unrecognised else float(np.prod([max(reel) for reel in weights]))
+    return {'positions': positions, 'weights': weights, 'confidence': confidence, 'unrecognised': unrecognised}
+
+# outcome tables already built, keyed by the reels, offsets and
+# paytable they were built from
+outcometables = {}
+
+# input: dictionary of payout winning values (missing labels pay 0)
+# output: dictionary of arrays indexed by the reel indices (i, j, k)
+#         of the top row:
+#           'lines'    - 20x20x20x5 uint8, symbol paid on each line of
+#                        paylines (0 if none)
+#           'clover'   - 20x20x20 uint8, 7 if a clover pattern is present
+#           'payouts'  - 20x20x20x3, winnings of landing on the state
+#                        w.r.t. betsize
+#           'weighted' - 20x20x20x3, the same winnings weighed over
+#                        every offset that can be applied from the state
+#
+# Precomputes the outcome of every one of the 8000 states at once with
+# comparelines and spin_payouts, so the outcome of a spin is a single
+# lookup. The
+# table is rebuilt whenever reels, offsets, offsetweights or the
+# paytable change. Profits stay float64 so that ties compare
+# exactly, as they did when they were summed one offset at a time.
+@instrument.stage('outcome_table')
+def outcome_table(winnings):
+    key = (str(reels), str(offsets), str(offsetweights), str(sorted(winnings.items())))
+    if key not in outcometables:
+        # the nine blocks visible at every state, one row per state
+        reelarray = np.array(reels)
+        indices = np.unravel_index(np.arange(8000), (20, 20, 20))
+        spins = np.stack([reelarray[reel][(indices[reel] + row) % 20] for row in range(3) for reel in range(3)], axis=1)
+
+        lines = np.stack([comparelines(spins[:, x[0]], spins[:, x[1]], spins[:, x[2]])
+                          for x in paylines.values()], axis=1).reshape(20, 20, 20, len(paylines)).astype(np.uint8)
+        clover = compareclovers(spins).reshape(20, 20, 20).astype(np.uint8)
+        payouts = spin_payouts(spins, winnings).reshape(20, 20, 20, 3).astype(np.float64)
+
+        weighted = np.zeros((20, 20, 20, 3))
+        for offset, weight in zip(offsets, offsetweights):
+            weighted += weight * np.roll(payouts, (-offset[0], -offset[1], -offset[2]), axis=(0, 1, 2))
+
+        outcometables.clear()
+        outcometables[key] = {'lines': lines, 'clover': clover, 'payouts': payouts, 'weighted': weighted}
+    return outcometables[key]
+
+# input: current spin in the dataset, dictionary of payout
+#        winning values (optional)
 # output: array of weighted profits w.r.t. betsize
 #
 # calculates the weighted profits of the current
 # state of the machine when it is spun. The correct
-# indices in reels have to be found, then each offset
-# is applied and weights are incremented based on
-# likelihood of the win occuring multiplied by its size.
-def find_probabilities(spin):
-    # holds the pointers to the values in reels
-    indices = [-1,-1,-1]
-
-    # find the correct indices in this spin as represented by
-    # reels. 
-    for reel in range(3):
-        streak = 0
-        # if the first block begins at the last or second to last index, the index
-        # loops around with modulo
-        for block in range(22):
-            if spin[streak * 3 + reel] == reels[reel][block % 20]:
-                streak = streak + 1
-            else:
-                if spin[streak * 3 + reel] == reels[reel][block % 20]:
-                    streak = 1 
-                else:
-                    streak = 0
-            if streak == 3: # index has been found
-                indices[reel] = (block - 2) % 20
-                break
-    
+# indices in reels have to be found, then the profits
+# are looked up in outcome_table, where each offset
+# was applied and weighted by the likelihood of the win
+# occuring multiplied by its size.
+@instrument.stage('find_probabilities')
+def find_probabilities(spin, winnings=None):
+    # find the candidate indices of each reel in this spin as
+    # represented by reels
+    location = locate_reels(spin)
+    if location['unrecognised']:
+        # a window that appears nowhere on its reel is a labelling
+        # error; with no information the player bets the minimum
+        return [0,0,0]
+
+    # these values were found from optimize_profit; I only changed
+    # the payout of diamonds from 32 to 64.
+    if winnings is None:
+        winnings = {'1': 2, '2': 8, '3': 20, '4': 0, '5': 64, '6': 0}
+
     # these returned values are the heuristic model for
     # this attack on the machine. The player's next
     # decision will be based on the highest number of
     # the three, and will choose the leftmost value in
     # the case of one or more ties. Each index corresponds
-    # to betsize.
-    weightedprofits = [0,0,0]
-
-    # these values were found from optimize_profit; I only changed
-    # the payout of diamonds from 32 to 64.
-    winnings = {'1': 2, '2': 8, '3': 20, '4': 0, '5': 64, '6': 0}
-
-    # the theoretical probabilities of each offset being applied.
-    # this array lines up with the offsets array near the top of
-    # the class.
-    weights = [0.125, 0.125, 0.25, 0.5]
-
-    for offset in range(4):
-        # apply the transformation
-        newresult = [0,0,0]
-        for index in range(3):
-            newresult[index] = (indices[index] + offsets[offset][index]) % 20
-
-        # establish variables for comparison
-        b1 = reels[0][newresult[0]]
-        b2 = reels[1][newresult[1]]
-        b3 = reels[2][newresult[2]]
-        b4 = reels[0][(newresult[0] + 1) % 20]
-        b5 = reels[1][(newresult[1] + 1) % 20]
-        b6 = reels[2][(newresult[2] + 1) % 20]
-        b7 = reels[0][(newresult[0] + 2) % 20]
-        b8 = reels[1][(newresult[1] + 2) % 20]
-        b9 = reels[2][(newresult[2] + 2) % 20]
-
-        # middle line
-        symbol = compareline(b4, b5, b6)
-        if symbol:
-            for i in range(3):
-                weightedprofits[i] = weightedprofits[i] + (weights[offset] * winnings[str(symbol)])
-
-        # top line
-        symbol = compareline(b1, b2, b3)
-        if symbol:
-            for i in range(2):
-                weightedprofits[i+1] = weightedprofits[i+1] + (weights[offset] * winnings[str(symbol)])
-
-        # bottom line
-        symbol = compareline(b7, b8, b9)
-        if symbol:
-            for i in range(2):
-                weightedprofits[i+1] = weightedprofits[i+1] + (weights[offset] * winnings[str(symbol)])
-
-        # first diagonal
-        symbol = compareline(b1, b5, b9)
-        if symbol:
-            weightedprofits[2] = weightedprofits[2] + (weights[offset] * winnings[str(symbol)])
-
-        # second diagonal
-        symbol = compareline(b7, b5, b3)
-        if symbol:
-            weightedprofits[2] = weightedprofits[2] + (weights[offset] * winnings[str(symbol)])
-
-    return weightedprofits
-
-# input: mysql cursor, initial state of machine
+    # to betsize. Every offset applied to this state was
+    # already weighed when the outcome table was built.
+    # When a window is ambiguous the profits are averaged over every
+    # candidate state, weighed by the candidates' weights.
+    table = outcome_table(winnings)
+    candidates = location['positions']
+    if location['confidence'] == 1:
+        return table['weighted'][candidates[0][0], candidates[1][0], candidates[2][0]].tolist()
+    weights = [np.array(reel) for reel in location['weights']]
+    return np.einsum('i,j,k,ijkb->b', *weights, table['weighted'][np.ix_(*candidates)]).tolist()
+
+# input: reel indices of the top row
+# output: the nine blocks (b1, ..., b9) visible at those indices
+def reelwindow(indices):
+    spin = [0] * 9
+    for row in range(3):
+        for reel in range(3):
+            spin[3 * row + reel] = reels[reel][(indices[reel] + row) % 20]
+    return spin
+
+# input: mysql cursor, initial state of machine, Nx9 array
+#        of spins to use instead of the database (optional)
 # output: dictionary of player profit and money saved
-# compared to statically betting 3 diamonds a spin
+# compared to statically betting 3 diamonds a spin, and the
+# number of spins whose reels could not be located
 #
 # Uses find_probabilities on each spin in the
 # dataset to make betting decisions based on the
 # weights returned and outputs the relevant
 # information.
-def maximize_profit(dbcursor, initialspin):
+@instrument.stage('maximize_profit')
+def maximize_profit(dbcursor, initialspin, spins=None):
     cost = 0
     # edge case: initial spin
     weights = find_probabilities(initialspin)
@@ -339,10 +660,19 @@ def maximize_profit(dbcursor, initialspin):
     # pull from all spins; the assumption that all spins in the dataset are
     # adjacent to one another is made and could potentially skew
     # the data.
-    dbcursor.execute('USE slots_data;')
-    dbcursor.execute('SELECT b1, b2, b3, b4, b5, b6, b7, b8, b9 FROM spins;')
-    spins = dbcursor.fetchall()
+    fromdatabase = spins is None
+    if fromdatabase:
+        database.use_database(dbcursor)
+        dbcursor.execute('SELECT b1, b2, b3, b4, b5, b6, b7, b8, b9 FROM spins;')
+        spins = dbcursor.fetchall()
+        if instrument.enabled:
+            instrument.add(rows=len(spins), queries=1)
+    else:
+        spins = np.asarray(spins).astype(np.int64).tolist()
+    unrecognised = 0
     for spin in spins:
+        if locate_reels(spin)['unrecognised']:
+            unrecognised = unrecognised + 1
         weights = find_probabilities(spin)
         # uncomment this print statement to see all weights in the
         # dataset for each spin
@@ -363,19 +693,38 @@ def maximize_profit(dbcursor, initialspin):
     # return the profit of the user; prizes represents the machine
     # profit so it must be negated. Since this heuristic will reach
     # all payouts available in the dataset, I took a shortcut and pulled from
-    # runsimulator, then added the cost of betting 3 diamonds 1000
-    # times and subtracting what the player spent in this function.
-    prizes = run_simulator(dbcursor, {'1': 2, '2': 8, '3': 20, '4': 0, '5': 64, '6': 0, '7': 0})
-    diff = 3000 - cost
-    return {'profit': -prizes[2] + diff, 'savings': diff} 
+    # runsimulator, then added the cost of betting 3 diamonds on every
+    # spin and subtracting what the player spent in this function.
+    winnings = {'1': 2, '2': 8, '3': 20, '4': 0, '5': 64, '6': 0, '7': 0}
+    if fromdatabase:
+        prizes = run_simulator(dbcursor, winnings)
+    else:
+        prizes = evaluate_paytable(len(spins), array_counts(spins), winnings)
+    diff = 3 * len(spins) - cost
+    return {'profit': -prizes[2] + diff, 'savings': diff, 'unrecognised': unrecognised}
     
 
 # main driver; I used this interchangeably with the
 # interpreter for debugging
 if __name__ == '__main__':
-    validentries = optimize_profit(mydb.cursor())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sqlite', metavar='PATH', help='read spins from a local SQLite file instead of MySQL')
+    parser.add_argument('--store', metavar='PATH', help='also run maximize_profit on the spins of a spin store')
+    instrument.add_argument(parser)
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrument.enable()
+    db = database.get_connection(path=args.sqlite)
+
+    validentries = optimize_profit(db.cursor())
     prizes = []
     for entry in validentries:
-        prizes.append(run_simulator(mydb.cursor(), entry))
+        prizes.append(run_simulator(db.cursor(), entry))
         print(entry)
-    print(prizes)
\ No newline at end of file
+    print(prizes)
+    if args.store:
+        import spinstore
+        spins = spinstore.labels(spinstore.open_spins(args.store))
+        print(maximize_profit(None, spins[0].tolist(), spins[1:]))
+    print(database.connection_stats())
+    instrument.finish(args.profile)
\ No newline at end of file
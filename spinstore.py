@@ -0,0 +1,185 @@
+# This class contains a compact on-disk spin store, an alternative
+# to the spins table for the analyses. Every spin is stored as 9 bytes,
+# one uint8 label per block (b1..b9, 255 for an unlabelled block), one
+# spin after another, after a fixed-size header:
+#
+#   magic     8 bytes  b'SPINSTOR'
+#   version   uint32
+#   width     uint32   bytes per spin (9)
+#   count     uint64   number of spins stored
+#   first     uint64   spin number (s) of the first spin
+#   metalen   uint32   length of the JSON metadata that follows
+#   metadata  JSON     e.g. where the spins came from
+#
+# All integers are little endian and the header is padded to
+# header_size bytes. Readers memory-map the spins, so opening a file
+# of millions of spins copies nothing and any range of it can be
+# sliced directly. Writers append spins at the end of the file and
+# only then update count, so a crash mid-append leaves the file as it
+# was before the append started.
+
+import database
+import json
+import numpy as np
+import os
+import struct
+
+magic = b'SPINSTOR'
+version = 1
+width = 9
+header_size = 4096
+header_format = '<8sIIQQI'
+
+# spins copied at a time when a store is rewritten
+copy_chunk = 1 << 20
+
+# input: path of the store, spin number of the first spin, metadata dictionary
+# output: N/A
+#
+# Creates an empty store, replacing any file at path.
+def create(path, first=1, metadata=None):
+    meta = json.dumps(metadata or {}).encode('utf-8')
+    if struct.calcsize(header_format) + len(meta) > header_size:
+        raise ValueError('metadata does not fit in the spin store header')
+    header = struct.pack(header_format, magic, version, width, 0, first, len(meta)) + meta
+    with open(path, 'wb') as f:
+        f.write(header.ljust(header_size, b'\0'))
+
+# input: path of the store
+# output: dictionary of the header fields and metadata
+def read_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(header_size)
+    fields = struct.unpack_from(header_format, header)
+    if fields[0] != magic:
+        raise ValueError(path + ' is not a spin store')
+    if fields[1] != version or fields[2] != width:
+        raise ValueError(path + ' has an unsupported spin store layout')
+    start = struct.calcsize(header_format)
+    return {'count': fields[3], 'first': fields[4],
+            'metadata': json.loads(header[start:start + fields[5]].decode('utf-8'))}
+
+# input: path of the store, first and last spin index to map (optional)
+# output: read-only memory-mapped Nx9 uint8 array of the spins
+#
+# Spins are indexed from 0 here; spin number s is at index s - first.
+def open_spins(path, start=0, stop=None):
+    count = read_header(path)['count']
+    stop = count if stop is None else min(stop, count)
+    if stop <= start:
+        return np.zeros((0, width), dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=header_size + start * width, shape=(stop - start, width))
+
+# input: Nx9 array of stored spins
+# output: Nx9 int64 array of the same spins with unlabelled blocks as -1
+#
+# Converts spins read from a store back to the labels the analyses
+# expect, since 255 would otherwise read as a symbol.
+def labels(spins):
+    spins = np.asarray(spins).astype(np.int64)
+    spins[spins == 255] = -1
+    return spins
+
+# input: path of the store, Nx9 array or iterable of spin rows (either
+#        b1..b9 or s, b1..b9 as yielded by importdata.stream_spins)
+# output: number of spins in the store after the append
+#
+# Appends spins to the end of the store, creating it if needed. Labels
+# of -1 are stored as 255.
+def append(path, spins):
+    if not os.path.exists(path):
+        create(path)
+    spins = np.asarray(list(spins) if not isinstance(spins, np.ndarray) else spins)
+    if spins.ndim == 2 and spins.shape[1] == width + 1:
+        spins = spins[:, 1:]
+    spins = spins.reshape(-1, width).astype(np.int64) % 256
+
+    count = read_header(path)['count']
+    with open(path, 'r+b') as f:
+        f.seek(header_size + count * width)
+        f.write(spins.astype(np.uint8).tobytes())
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        count = count + len(spins)
+        f.seek(struct.calcsize('<8sII'))
+        f.write(struct.pack('<Q', count))
+        f.flush()
+        os.fsync(f.fileno())
+    return count
+
+# input: path of the store, new spin number of the first spin
+# output: N/A
+#
+# Moves the first spin of the store back to an earlier spin number,
+# filling the spins in between with unlabelled spins. The store is
+# rewritten to a temporary file that then replaces it, so a crash
+# leaves either the old store or the new one.
+def prepend(path, first):
+    header = read_header(path)
+    shift = header['first'] - first
+    if shift <= 0:
+        return
+    temp = path + '.tmp'
+    create(temp, first, header['metadata'])
+    spins = open_spins(path)
+    with open(temp, 'r+b') as f:
+        f.seek(header_size)
+        f.write(b'\xff' * (shift * width))
+        for start in range(0, len(spins), copy_chunk):
+            f.write(spins[start:start + copy_chunk].tobytes())
+        f.seek(struct.calcsize('<8sII'))
+        f.write(struct.pack('<Q', header['count'] + shift))
+        f.flush()
+        os.fsync(f.fileno())
+    del spins
+    os.replace(temp, path)
+
+# input: path of the store, iterable of spin rows (s, b1, ..., b9)
+# output: number of spins in the store after the write
+#
+# Writes every spin at the position of its spin number, overwriting
+# any spin already stored there. Positions past the end of the store
+# are appended, with unlabelled spins (all 255) filling any gap, so
+# writing the same rows twice leaves the store as writing them once.
+# A new store starts at the smallest spin number written; spin numbers
+# before the first spin of an existing store move it back first.
+def put(path, rows):
+    rows = np.array(list(rows), dtype=np.int64).reshape(-1, width + 1)
+    if not len(rows):
+        return read_header(path)['count'] if os.path.exists(path) else 0
+    if not os.path.exists(path):
+        create(path, int(rows[:, 0].min()))
+    header = read_header(path)
+    if rows[:, 0].min() < header['first']:
+        prepend(path, int(rows[:, 0].min()))
+        header = read_header(path)
+    positions = rows[:, 0] - header['first']
+    count = header['count']
+
+    # overwrite spins already in the store in place
+    inside = positions < count
+    if inside.any():
+        spins = np.memmap(path, dtype=np.uint8, mode='r+', offset=header_size, shape=(count, width))
+        spins[positions[inside]] = rows[inside, 1:] % 256
+        spins.flush()
+        del spins
+
+    # and append the rest, gaps included
+    if not inside.all():
+        extra = np.full((int(positions.max()) + 1 - count, width), 255, dtype=np.int64)
+        extra[positions[~inside] - count] = rows[~inside, 1:]
+        count = append(path, extra)
+    return count
+
+# input: path of the store, database cursor
+# output: number of spins in the store
+#
+# Copies the spins table into a new store.
+def from_database(path, dbcursor):
+    database.use_database(dbcursor)
+    dbcursor.execute('SELECT MIN(s) FROM spins')
+    first = dbcursor.fetchone()[0] or 1
+    dbcursor.execute('SELECT b1, b2, b3, b4, b5, b6, b7, b8, b9 FROM spins ORDER BY s')
+    create(path, first, {'source': 'spins table'})
+    return append(path, np.array(dbcursor.fetchall(), dtype=np.int64).reshape(-1, width))
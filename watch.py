@@ -0,0 +1,297 @@
+# This class contains the live mode of the import: it follows the raw
+# screenshots folder while the machine is being played and handles
+# every new spin (N).png as soon as it is fully written, instead of
+# importing hundreds of screenshots in one batch afterwards. Each spin
+# goes through three stages joined by asyncio queues:
+#   -the watcher polls the folder and queues every screenshot whose PNG
+#    trailer has been written and that the manifest does not know yet
+#   -labellers hand the screenshots to a process pool whose workers
+#    were warmed up before the first frame (geometry cache loaded,
+#    decoder and classifier run once)
+#   -the committer writes whatever spins are ready as one batch to the
+#    spin store or the spins table, records them in the manifest and
+#    updates the running payout counts
+# The queue in front of the labellers is bounded, so when screenshots
+# arrive faster than they can be labelled the watcher stops queueing
+# them and they wait on disk until there is room again.
+#
+# The running counts are the per-line sums of runanalyses.line_counts:
+# they are loaded once at start and each batch adds its own spins (and
+# takes away the old labels of a screenshot that was replaced), so the
+# frequencies at every bet size are current without rereading the
+# table. Every spin also gets the bet recommended by the
+# find_probabilities heuristic from the outcome table, which is built
+# once at start. The latency of every spin, from the screenshot being
+# written (or the session starting, for screenshots that were already
+# waiting) to its spin being committed, is kept and reported as
+# percentiles.
+
+import argparse
+import asyncio
+import cv2 as cv
+import numpy as np
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import backtest
+import database
+import geometry
+import importdata
+import instrument
+import manifest
+import runanalyses as ra
+import spinstore
+
+# seconds between scans of the screenshots folder
+poll_interval = 0.05
+
+# screenshots queued for labelling per worker before the watcher waits
+queue_depth = 2
+
+# most spins written in one batch
+max_batch = 64
+
+# latencies kept for the percentiles
+max_latencies = 10000
+
+# last bytes of every complete PNG file: the IEND chunk and its CRC
+png_trailer = b'IEND\xaeB`\x82'
+
+# input: workspace path
+# output: N/A
+#
+# Initializer of every worker process: loads the crop boxes and runs
+# the decoder and the classifier once, so the first real screenshot
+# costs no more than any other.
+def warm(workspace):
+    importdata.root_dir = workspace
+    geometry.load_cache()
+    sample = cv.imdecode(cv.imencode('.png', np.zeros((64, 64, 3), dtype=np.uint8))[1], cv.IMREAD_COLOR)
+    importdata.classify_blocks(np.stack([sample[:, :, ::-1]] * 9))
+
+# input: spin number, screenshot path
+# output: (spin row (s, b1, ..., b9), SHA-1 of the screenshot)
+@instrument.stage('label_screenshot')
+def label_screenshot(spin, path):
+    return importdata.label_spin(spin, importdata.root_dir, path=path), manifest.file_hash(path)
+
+# input: file path
+# output: whether the file ends with the PNG trailer
+def complete(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(-len(png_trailer), os.SEEK_END)
+            return f.read() == png_trailer
+    except OSError:
+        return False
+
+# input: screenshots folder, manifest dictionary, names already queued,
+#        dictionary of (size, modification time) of the screenshots that
+#        failed to label by name
+# output: list of manifest entries of the complete screenshots to label,
+#         ordered by spin number
+#
+# Only files named spin (N).png are picked up, as spin N. A file is
+# new when the manifest has no record of it or its size or
+# modification time differ from the record. A screenshot that failed
+# to label is skipped until it changes.
+def new_screenshots(directory, state, queued, failed=None):
+    failed = {} if failed is None else failed
+    entries = []
+    for item in os.scandir(directory):
+        match = manifest.name_pattern.match(item.name)
+        if not match or item.name in queued:
+            continue
+        stat = item.stat()
+        if failed.get(item.name) == (stat.st_size, stat.st_mtime_ns):
+            continue
+        recorded = state['files'].get(item.name)
+        if recorded and recorded['size'] == stat.st_size and recorded['mtime'] == stat.st_mtime_ns:
+            continue
+        if complete(item.path):
+            entries.append({'name': item.name, 'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                            'spin': int(match.group(1)), 'path': item.path})
+    return sorted(entries, key=lambda entry: entry['spin'])
+
+# input: dictionary of line counts, dictionary of line counts to add,
+#        sign of the addition
+# output: N/A
+def add_counts(counts, other, sign=1):
+    for key in counts:
+        counts[key] = [count + sign * change for count, change in zip(counts[key], other[key])]
+
+# input: list of latencies in seconds
+# output: string of their percentiles in milliseconds
+def percentiles(latencies):
+    if not latencies:
+        return 'NO SPINS'
+    p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+    return ('P50 ' + str(round(p50, 1)) + 'MS, P90 ' + str(round(p90, 1)) + 'MS, P99 ' + str(round(p99, 1)) +
+            'MS, MAX ' + str(round(1000 * max(latencies), 1)) + 'MS OVER ' + str(len(latencies)) + ' SPINS')
+
+# Keeps the state of one watch session: the manifest, the running line
+# counts, the paytable recommendations are made against and the
+# latencies measured so far.
+class Session:
+
+    def __init__(self, directory, manifestpath, write, counts, winnings=backtest.dynamicwinnings):
+        self.directory = directory
+        self.manifestpath = manifestpath
+        self.state = manifest.load(manifestpath)
+        self.write = write
+        self.counts = counts
+        self.winnings = winnings
+        self.queued = set()
+        self.failed = {}
+        self.latencies = deque(maxlen=max_latencies)
+        self.processed = 0
+        self.started = time.time()
+        ra.outcome_table(winnings)
+
+    # input: list of (manifest entry, spin row, SHA-1) labelled
+    # output: N/A
+    #
+    # Writes the batch, records it in the manifest and updates the
+    # running counts, then prints every spin with its recommended bet.
+    def commit(self, batch):
+        rows = [row for entry, row, digest in batch]
+        self.write(rows)
+        replaced = [self.state['files'][entry['name']]['labels'] for entry, row, digest in batch
+                    if entry['name'] in self.state['files']]
+        if replaced:
+            add_counts(self.counts, ra.array_line_counts(replaced), -1)
+        add_counts(self.counts, ra.array_line_counts([row[1:] for row in rows]))
+        for entry, row, digest in batch:
+            record = {key: entry[key] for key in ('name', 'size', 'mtime', 'spin')}
+            manifest.record(self.state, dict(record, sha1=digest), row)
+        manifest.save(self.manifestpath, self.state)
+
+        now = time.time()
+        for entry, row, digest in batch:
+            self.queued.discard(entry['name'])
+            self.failed.pop(entry['name'], None)
+            latency = now - max(entry['mtime'] / 1e9, self.started)
+            self.latencies.append(latency)
+            weights = ra.find_probabilities(list(row[1:]), self.winnings)
+            bet = int(backtest.heuristic_bet(weights))
+            print('SPIN ' + str(row[0]) + ': ' + str(list(row[1:])) + ' BET ' + str(bet) + ' ' +
+                  str([round(weight, 3) for weight in weights]) + ' (' + str(round(1000 * latency, 1)) + 'MS)')
+        self.processed = self.processed + len(batch)
+
+    # input: N/A
+    # output: dictionary of the running payout frequencies at 3 diamonds
+    def frequencies(self):
+        return ra.bet_frequencies(self.counts, 3)
+
+# input: session, process pool, number of labellers, number of spins
+#        to stop after (optional), seconds without a new screenshot to
+#        stop after (optional)
+# output: N/A
+#
+# Runs the watcher, the labellers and the committer until the limits
+# are reached (or forever). Spins labelled but not yet committed when
+# it stops are not in the manifest, so the next session redoes them.
+async def watch(session, pool, workers=1, limit=None, idle=None):
+    waiting = asyncio.Queue(maxsize=queue_depth * workers)
+    labelled = asyncio.Queue()
+    done = asyncio.Event()
+
+    async def watcher():
+        lastseen = time.monotonic()
+        while not done.is_set():
+            for entry in new_screenshots(session.directory, session.state, session.queued, session.failed):
+                session.queued.add(entry['name'])
+                await waiting.put(entry)
+                if entry['name'] not in session.failed: # a retry is not new activity
+                    lastseen = time.monotonic()
+            if idle is not None and not session.queued and time.monotonic() - lastseen > idle:
+                done.set()
+            await asyncio.sleep(poll_interval)
+
+    async def labeller():
+        while True:
+            entry = await waiting.get()
+            future = instrument.submit(pool, label_screenshot, entry['spin'], entry['path'])
+            try:
+                await asyncio.wrap_future(getattr(future, 'future', future))
+                row, digest = future.result()
+            except Exception as e:
+                print('FAILED TO LABEL ' + entry['name'] + ': ' + repr(e))
+                session.failed[entry['name']] = (entry['size'], entry['mtime'])
+                session.queued.discard(entry['name'])
+                continue
+            await labelled.put((entry, row, digest))
+
+    async def committer():
+        while True:
+            batch = [await labelled.get()]
+            while not labelled.empty() and len(batch) < max_batch:
+                batch.append(labelled.get_nowait())
+            session.commit(batch)
+            if limit is not None and session.processed >= limit:
+                done.set()
+
+    tasks = ([asyncio.create_task(watcher()), asyncio.create_task(committer())] +
+             [asyncio.create_task(labeller()) for n in range(workers)])
+    finishing = asyncio.create_task(done.wait())
+    try:
+        finished, running = await asyncio.wait(tasks + [finishing], return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            task.result() # a stage that stopped early raised; pass it on
+    finally:
+        for task in tasks + [finishing]:
+            task.cancel()
+        await asyncio.gather(*tasks, finishing, return_exceptions=True)
+
+# input: spin store path
+# output: line counts of the spins in the store, skipping gaps
+def store_counts(path):
+    if not os.path.exists(path):
+        return ra.array_line_counts(np.zeros((0, 9), dtype=np.int64))
+    spins = spinstore.labels(spinstore.open_spins(path))
+    return ra.array_line_counts(spins[(spins != -1).any(axis=1)])
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', metavar='PATH', help='screenshots folder to watch (defaults to raw_images/)')
+    parser.add_argument('--workers', type=int, default=1, help='processes labelling screenshots')
+    parser.add_argument('--sqlite', metavar='PATH', help='write to a local SQLite file instead of MySQL')
+    parser.add_argument('--store', metavar='PATH', help='write to a spin store instead of the spins table')
+    parser.add_argument('--manifest', metavar='PATH', help='manifest of imported raw images (defaults to one next to the target)')
+    parser.add_argument('--count', type=int, default=None, help='stop after this many spins')
+    parser.add_argument('--idle', type=float, default=None, help='stop after this many seconds without a new screenshot')
+    instrument.add_argument(parser)
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrument.enable()
+
+    directory = args.directory or os.path.join(importdata.root_dir, 'raw_images')
+    target = args.store or args.sqlite or os.path.join(importdata.root_dir, 'slots_data')
+    if args.store:
+        write = lambda rows: spinstore.put(args.store, rows)
+        counts = store_counts(args.store)
+    else:
+        db = database.get_connection(path=args.sqlite)
+        importdata.init_database(db.cursor())
+        write = lambda rows: importdata.write_spins(db.cursor(), rows)
+        counts = ra.line_counts(db.cursor())
+    session = Session(directory, args.manifest or target + '.manifest.json', write, counts)
+    print('WATCHING ' + directory + ' (' + str(len(session.state['files'])) + ' SCREENSHOTS ALREADY IMPORTED)')
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=warm, initargs=(importdata.root_dir,)) as pool:
+        # start the workers before the first screenshot arrives
+        list(pool.map(abs, range(args.workers)))
+        try:
+            asyncio.run(watch(session, pool, args.workers, args.count, args.idle))
+        except KeyboardInterrupt:
+            pass
+    elapsed = time.perf_counter() - start
+
+    print('PROCESSED ' + str(session.processed) + ' SPINS IN ' + str(round(elapsed, 2)) + 'S')
+    print('LATENCY: ' + percentiles(list(session.latencies)))
+    print('FREQUENCIES AT 3 DIAMONDS: ' + str(session.frequencies()))
+    instrument.finish(args.profile)
@@ -0,0 +1,402 @@
+# This class contains a reader for the machine in a Minecraft world
+# save, so the reels table of runanalyses.py can be read from the build
+# instead of transcribed by hand. Each reel is a loop of 20 symbol
+# blocks standing in one x plane; the three blocks of its window are
+# the top of the loop's front column. Starting from the top block of
+# each window, extract_reels follows the loop downwards and around
+# until it is back where it started, reading one block at a time.
+#
+# Blocks are read from the Anvil region files of the world
+# (region/r.X.Z.mca). A region file is memory-mapped and only its
+# 8KB header is looked at until a block is asked for; then the one
+# chunk holding it is sliced out of the map and decompressed, and the
+# palette of the one 16x16x16 section holding it is unpacked. A whole
+# region file is never read, and only the chunks the reels stand in
+# are ever decompressed. Exports of the machine made with Amulet
+# (.construction files) hold the same NBT and are read the same way.
+#
+# The extracted reels are cached in a JSON file with the size,
+# modification time and SHA-1 hash of every file they were read from.
+# A file whose size and modification time are unchanged is not read
+# again; one that was only touched is recognised by its hash.
+#
+# The offsets are wired into the redstone as pulse counts rather than
+# stored as blocks, so they are not extracted.
+
+import argparse
+import gzip
+import json
+import math
+import mmap
+import numpy as np
+import os
+import struct
+import zlib
+
+import instrument
+import manifest
+import runanalyses as ra
+
+# label of each symbol block, as in the spins table
+symbols = {'minecraft:amethyst_block': 0, 'minecraft:iron_block': 1, 'minecraft:raw_gold_block': 2,
+           'minecraft:gold_block': 3, 'minecraft:emerald_block': 4, 'minecraft:diamond_block': 5,
+           'minecraft:netherite_block': 6, 'minecraft:lime_glazed_terracotta': 7}
+
+# (x, y, z) of the top block of each reel's window, reel 0 first; the
+# reels are read downwards from there
+windows = [(-165, 106, -75), (-166, 106, -75), (-167, 106, -75)]
+
+# extracted reels, relative to the world or construction file
+cache_path = 'world_reels.json'
+
+# most blocks followed around one reel before giving up
+max_loop = 64
+
+# input: bytes of an NBT tag's payload, position, tag type
+# output: (value of the tag, position after it)
+#
+# Compounds become dictionaries and lists become lists; int and long
+# arrays are numpy views of the buffer, so they are not copied.
+def read_tag(buf, pos, tagtype):
+    if tagtype == 1:
+        return struct.unpack_from('>b', buf, pos)[0], pos + 1
+    if tagtype == 2:
+        return struct.unpack_from('>h', buf, pos)[0], pos + 2
+    if tagtype == 3:
+        return struct.unpack_from('>i', buf, pos)[0], pos + 4
+    if tagtype == 4:
+        return struct.unpack_from('>q', buf, pos)[0], pos + 8
+    if tagtype == 5:
+        return struct.unpack_from('>f', buf, pos)[0], pos + 4
+    if tagtype == 6:
+        return struct.unpack_from('>d', buf, pos)[0], pos + 8
+    if tagtype == 7:
+        length = struct.unpack_from('>i', buf, pos)[0]
+        return bytes(buf[pos + 4:pos + 4 + length]), pos + 4 + length
+    if tagtype == 8:
+        length = struct.unpack_from('>H', buf, pos)[0]
+        return bytes(buf[pos + 2:pos + 2 + length]).decode('utf-8', 'replace'), pos + 2 + length
+    if tagtype == 9:
+        itemtype = buf[pos]
+        length = struct.unpack_from('>i', buf, pos + 1)[0]
+        pos = pos + 5
+        items = []
+        for n in range(length):
+            item, pos = read_tag(buf, pos, itemtype)
+            items.append(item)
+        return items, pos
+    if tagtype == 10:
+        compound = {}
+        while buf[pos] != 0:
+            itemtype = buf[pos]
+            length = struct.unpack_from('>H', buf, pos + 1)[0]
+            name = bytes(buf[pos + 3:pos + 3 + length]).decode('utf-8', 'replace')
+            compound[name], pos = read_tag(buf, pos + 3 + length, itemtype)
+        return compound, pos + 1
+    if tagtype == 11:
+        length = struct.unpack_from('>i', buf, pos)[0]
+        return np.frombuffer(buf, '>i4', length, pos + 4), pos + 4 + 4 * length
+    if tagtype == 12:
+        length = struct.unpack_from('>i', buf, pos)[0]
+        return np.frombuffer(buf, '>i8', length, pos + 4), pos + 4 + 8 * length
+    raise ValueError('unknown NBT tag type ' + str(tagtype))
+
+# input: bytes of an uncompressed NBT file
+# output: its root compound
+def read_nbt(buf):
+    if buf[0] != 10:
+        raise ValueError('NBT data does not start with a compound')
+    length = struct.unpack_from('>H', buf, 1)[0]
+    return read_tag(buf, 3 + length, 10)[0]
+
+# input: array of packed longs, palette length, number of entries
+# output: array of the palette index of every entry
+#
+# Block states are packed into as few bits as the palette needs, at
+# least 4, with no entry spanning two longs (Minecraft 1.16 and later).
+def unpack_states(longs, palettesize, count=4096):
+    if palettesize <= 1 or longs is None or not len(longs):
+        return np.zeros(count, dtype=np.int64)
+    bits = max(4, math.ceil(math.log2(palettesize)))
+    perlong = 64 // bits
+    values = np.asarray(longs).astype('>i8').view('>u8').astype(np.uint64)
+    shifts = np.arange(perlong, dtype=np.uint64) * np.uint64(bits)
+    states = (values[:, np.newaxis] >> shifts) & np.uint64((1 << bits) - 1)
+    return states.ravel()[:count].astype(np.int64)
+
+# Reads blocks from the Anvil region files of a world, decompressing
+# only the chunks that are asked for. Both the 1.18 chunk layout
+# (sections/block_states) and the older one (Level/Sections) are read.
+class RegionWorld:
+
+    def __init__(self, directory):
+        self.directory = os.path.join(directory, 'region')
+        self.maps = {} # (rx, rz) -> memory map of the region file, None if missing
+        self.chunks = {} # (cx, cz) -> dictionary of sections by y
+        self.sections = {} # (cx, sy, cz) -> (palette names, 4096 palette indices)
+        self.used = [] # region files read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # input: region coordinates
+    # output: memory map of the region file, None if it does not exist
+    def region(self, rx, rz):
+        if (rx, rz) not in self.maps:
+            path = os.path.join(self.directory, 'r.' + str(rx) + '.' + str(rz) + '.mca')
+            if not os.path.exists(path) or os.path.getsize(path) < 8192:
+                self.maps[(rx, rz)] = None
+            else:
+                with open(path, 'rb') as f:
+                    self.maps[(rx, rz)] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.used.append(path)
+        return self.maps[(rx, rz)]
+
+    # input: chunk coordinates
+    # output: dictionary of the chunk's NBT sections by y, None if the
+    #         chunk was never generated
+    #
+    # Slices the chunk out of its region file through the location
+    # table in the header and decompresses just that slice.
+    def chunk(self, cx, cz):
+        if (cx, cz) not in self.chunks:
+            regionmap = self.region(cx >> 5, cz >> 5)
+            if regionmap is None:
+                raise FileNotFoundError('no region file holds chunk (' + str(cx) + ', ' + str(cz) + ') in ' + self.directory)
+            location = struct.unpack_from('>I', regionmap, 4 * ((cx & 31) + 32 * (cz & 31)))[0]
+            if location >> 8 == 0:
+                self.chunks[(cx, cz)] = None
+                return None
+            start = (location >> 8) * 4096
+            length, compression = struct.unpack_from('>IB', regionmap, start)
+            if compression & 128: # stored outside the region file, in c.X.Z.mcc
+                with open(os.path.join(self.directory, 'c.' + str(cx) + '.' + str(cz) + '.mcc'), 'rb') as f:
+                    data = f.read()
+            else:
+                data = regionmap[start + 5:start + 4 + length]
+            if instrument.enabled:
+                instrument.add(rows=1, nbytes=len(data))
+            compression = compression & 127
+            if compression == 1:
+                data = gzip.decompress(data)
+            elif compression == 2:
+                data = zlib.decompress(data)
+            elif compression != 3:
+                raise ValueError('unknown compression ' + str(compression) + ' for chunk (' + str(cx) + ', ' + str(cz) + ')')
+            root = read_nbt(data)
+            level = root.get('Level', root)
+            self.chunks[(cx, cz)] = {section['Y']: section for section in level.get('sections', level.get('Sections', []))
+                                     if 'Y' in section}
+        return self.chunks[(cx, cz)]
+
+    # input: world coordinates
+    # output: namespaced name of the block there
+    def block(self, x, y, z):
+        key = (x >> 4, y >> 4, z >> 4)
+        if key not in self.sections:
+            chunk = self.chunk(x >> 4, z >> 4)
+            section = chunk.get(y >> 4) if chunk else None
+            if section is None:
+                self.sections[key] = (['minecraft:air'], np.zeros(4096, dtype=np.int64))
+            elif 'block_states' in section:
+                palette = section['block_states'].get('palette', [])
+                self.sections[key] = ([state['Name'] for state in palette],
+                                      unpack_states(section['block_states'].get('data'), len(palette)))
+            else:
+                palette = section.get('Palette', [])
+                self.sections[key] = ([state['Name'] for state in palette],
+                                      unpack_states(section.get('BlockStates'), len(palette)))
+        names, states = self.sections[key]
+        if not names:
+            return 'minecraft:air'
+        return names[states[256 * (y & 15) + 16 * (z & 15) + (x & 15)]]
+
+    # input: N/A
+    # output: N/A
+    def close(self):
+        for regionmap in self.maps.values():
+            if regionmap is not None:
+                regionmap.close()
+        self.maps.clear()
+
+# Reads blocks from an Amulet .construction export: a magic number, the
+# gzipped NBT of each section box, then gzipped NBT metadata holding the
+# selection, the block palette and a table locating every section. Only
+# the sections that are asked for are decompressed.
+class Construction:
+
+    magic = b'constrct'
+
+    def __init__(self, path):
+        self.path = path
+        self.used = [path]
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:8] != self.magic or self.map[-8:] != self.magic:
+            raise ValueError(path + ' is not a construction file')
+        start = struct.unpack_from('>I', self.map, len(self.map) - 12)[0]
+        metadata = read_nbt(gzip.decompress(self.map[start:len(self.map) - 12]))
+        self.palette = [state['namespace'] + ':' + state['blockname'] for state in metadata['block_palette']]
+        table = metadata['section_index_table']
+        # (x, y, z, width, height, depth, position, length) of every section
+        self.index = [struct.unpack_from('<iiiBBBii', table, 23 * n) for n in range(len(table) // 23)]
+        self.sections = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # input: world coordinates
+    # output: namespaced name of the block there
+    def block(self, x, y, z):
+        for entry in self.index:
+            sx, sy, sz, width, height, depth, position, length = entry
+            if sx <= x < sx + width and sy <= y < sy + height and sz <= z < sz + depth:
+                if entry not in self.sections:
+                    section = read_nbt(gzip.decompress(self.map[position:position + length]))
+                    if instrument.enabled:
+                        instrument.add(rows=1, nbytes=length)
+                    blocks = section.get('blocks')
+                    if blocks is None:
+                        self.sections[entry] = None
+                    else:
+                        if isinstance(blocks, bytes):
+                            blocks = np.frombuffer(blocks, dtype=np.uint8)
+                        self.sections[entry] = np.asarray(blocks).reshape(width, height, depth)
+                if self.sections[entry] is not None:
+                    return self.palette[self.sections[entry][x - sx, y - sy, z - sz]]
+        return 'minecraft:air'
+
+    # input: N/A
+    # output: N/A
+    def close(self):
+        self.map.close()
+
+# input: block source (RegionWorld or Construction), (x, y, z) of the
+#        top block of a reel's window
+# output: list of the labels around the reel, starting at that block
+#
+# Follows the loop of symbol blocks in the window's x plane: first
+# down the front column, then always on to the neighbour that is not
+# the block just left, preferring edge neighbours over the diagonal
+# steps at the loop's corners.
+def trace_reel(source, top):
+    x = top[0]
+    label = lambda y, z: symbols.get(source.block(x, y, z))
+    previous = (top[1], top[2])
+    current = (top[1] - 1, top[2])
+    if label(*previous) is None or label(*current) is None:
+        raise ValueError('no reel window at ' + str(top))
+    reel = [label(*previous)]
+    while current != (top[1], top[2]):
+        if len(reel) > max_loop:
+            raise ValueError('the reel at ' + str(top) + ' does not close into a loop')
+        reel.append(label(*current))
+        y, z = current
+        steps = [(y - 1, z), (y + 1, z), (y, z - 1), (y, z + 1),
+                 (y - 1, z - 1), (y - 1, z + 1), (y + 1, z - 1), (y + 1, z + 1)]
+        following = [step for step in steps if step != previous and label(*step) is not None]
+        if not following:
+            raise ValueError('the reel at ' + str(top) + ' breaks off at ' + str((x,) + current))
+        previous, current = current, following[0]
+    return reel
+
+# input: list of paths read from
+# output: dictionary of the size, modification time and hash of each
+def file_records(paths):
+    records = {}
+    for path in paths:
+        stat = os.stat(path)
+        records[path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha1': manifest.file_hash(path)}
+    return records
+
+# input: file records of a cache entry
+# output: whether every file is unchanged; the modification times of
+#         files that were only touched are updated
+def unchanged(records):
+    for path, record in records.items():
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != record['size']:
+            return False
+        if stat.st_mtime_ns != record['mtime']:
+            if manifest.file_hash(path) != record['sha1']:
+                return False
+            record['mtime'] = stat.st_mtime_ns
+    return True
+
+# input: world directory or .construction file, window positions, cache file
+# output: list of the three reels, each a list of labels starting at
+#         the top of its window
+@instrument.stage('extract_reels')
+def extract_reels(source='original_world', tops=windows, path=None):
+    path = cache_path if path is None else path
+    key = json.dumps([os.path.abspath(source), tops])
+    cached = {}
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    entry = cached.get(key)
+    if entry is not None and unchanged(entry['files']):
+        reels = entry['reels']
+    else:
+        opener = Construction if os.path.isfile(source) else RegionWorld
+        with opener(source) as blocks:
+            reels = [trace_reel(blocks, top) for top in tops]
+            used = list(blocks.used)
+        entry = {'files': file_records(used), 'reels': reels}
+    cached[key] = entry
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(cached, f, indent=1)
+    os.replace(temp, path)
+    return reels
+
+# input: extracted reels, reels to compare against
+# output: list of the shift of each extracted reel that matches the
+#         other (None where it matches at no shift)
+#
+# A reel read from another state of the machine is the same loop
+# started at another block.
+def align(reels, reference):
+    shifts = []
+    for reel, other in zip(reels, reference):
+        matches = [shift for shift in range(len(reel)) if len(reel) == len(other) and reel[shift:] + reel[:shift] == other]
+        shifts.append(matches[0] if matches else None)
+    return shifts
+
+# input: list of reels
+# output: the reels formatted like the reels table in runanalyses.py
+def format_reels(reels):
+    return 'reels = [' + ',\n'.join('[' + ','.join(str(label) for label in reel) + ']' for reel in reels) + ']'
+
+# main driver
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', nargs='?', default='original_world',
+                        help='world save directory or Amulet .construction file')
+    instrument.add_argument(parser)
+    args = parser.parse_args()
+    if args.profile is not None:
+        instrument.enable()
+
+    try:
+        reels = extract_reels(args.source)
+    except FileNotFoundError as e:
+        print('READ FAILED: ' + str(e))
+        print('THE MACHINE IS NOT IN THIS SAVE; AN EXPORT CAN BE READ INSTEAD (e.g. python worldreader.py isolated_machine.construction)')
+        raise SystemExit(1)
+    shifts = align(reels, ra.reels)
+    if all(shift is not None for shift in shifts):
+        print('THE REELS MATCH runanalyses.reels (SHIFTED BY ' + str(shifts) + ')')
+        reels = [reel[shift:] + reel[:shift] for reel, shift in zip(reels, shifts)]
+    else:
+        print('THE REELS DIFFER FROM runanalyses.reels AT REEL ' + str([n for n, shift in enumerate(shifts) if shift is None]))
+    print(format_reels(reels))
+    instrument.finish(args.profile)